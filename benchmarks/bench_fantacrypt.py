@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark for the fantacrypt codec.
+# Compares the original per-character implementation with server.fantacrypt.
+# Run from the repository root: python benchmarks/bench_fantacrypt.py
+
+import argparse
+import binascii
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import fantacrypt
+
+
+def legacy_decrypt(data):
+    data_bytes = [int(data[x:x + 2], 16) for x in range(0, len(data), 2)]
+    key = fantacrypt.CRYPT_KEY
+    ret = ''
+    for byte in data_bytes:
+        val = byte ^ ((key & 0xffff) >> 8)
+        ret += chr(val)
+        key = ((byte + key) * fantacrypt.CRYPT_CONST_1) + fantacrypt.CRYPT_CONST_2
+    return ret
+
+
+def legacy_encrypt(data):
+    key = fantacrypt.CRYPT_KEY
+    ret = ''
+    for char in data:
+        val = ord(char) ^ ((key & 0xffff) >> 8)
+        ret += binascii.hexlify(val.to_bytes(1, byteorder='big')).decode().upper()
+        key = ((val + key) * fantacrypt.CRYPT_CONST_1) + fantacrypt.CRYPT_CONST_2
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the fantacrypt codec.')
+    parser.add_argument('-l', '--length', type=int, action='append',
+                        help='plaintext length in characters; may be given several times')
+    parser.add_argument('-n', '--number', type=int, default=2000, help='calls per timed run')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed runs')
+    args = parser.parse_args()
+
+    for length in args.length or [2, 16, 256]:
+        # Headers of old clients are short, e.g. 'MS' or 'HI'
+        plain = ('MS#chat#' * (length // 8 + 1))[:length]
+        cipher = fantacrypt.fanta_encrypt(plain)
+        assert legacy_encrypt(plain) == cipher
+        assert legacy_decrypt(cipher) == fantacrypt.fanta_decrypt(cipher) == plain
+
+        print('{} characters:'.format(length))
+        for name, func, data in (('legacy encrypt', legacy_encrypt, plain),
+                                 ('encrypt', fantacrypt.fanta_encrypt, plain),
+                                 ('legacy decrypt', legacy_decrypt, cipher),
+                                 ('decrypt', fantacrypt.fanta_decrypt, cipher)):
+            best = min(timeit.repeat(lambda: func(data), number=args.number, repeat=args.repeat))
+            print('  {:<16}{:>10.2f} us/call'.format(name, best / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
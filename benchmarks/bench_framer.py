@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro-benchmark for the incoming packet framer.
+# Feeds 10k pipelined packets to both the old str-based splitter and PacketFramer.
+# Run from the repository root: python benchmarks/bench_framer.py
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server.packets import PacketFramer
+
+
+class StrFramer:
+    """
+    The splitter AOProtocol used before PacketFramer, kept here as a baseline.
+    """
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, data):
+        self.buffer += data.decode('utf-8', 'ignore')
+        return len(self.buffer) <= 8192
+
+    def get_messages(self):
+        messages = []
+        while '#%' in self.buffer:
+            spl = self.buffer.split('#%', 1)
+            self.buffer = spl[1]
+            messages.append(spl[0])
+        return messages
+
+
+def build_stream(count):
+    packets = []
+    for i in range(count):
+        packets.append('CT#user{}#message number {} with some text#%'.format(i % 50, i).encode('utf-8'))
+    return b''.join(packets)
+
+
+def chunked(stream, size):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def run(framer_type, chunks, limit):
+    framer = framer_type()
+    # lift the buffer size limit (oversized buffers disconnect the client), the benchmark measures splitting
+    framer.limit = limit
+    total = 0
+    for chunk in chunks:
+        framer.feed(chunk)
+        total += len(framer.get_messages())
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the incoming packet framer.')
+    parser.add_argument('-n', '--packets', type=int, default=10000, help='number of pipelined packets')
+    parser.add_argument('-c', '--chunk', type=int, default=0,
+                        help='bytes per read; 0 delivers the whole stream at once')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed runs')
+    args = parser.parse_args()
+
+    stream = build_stream(args.packets)
+    chunks = chunked(stream, args.chunk) if args.chunk > 0 else [stream]
+    limit = len(stream) + 1
+
+    for name, framer_type in (('str split', StrFramer), ('PacketFramer', PacketFramer)):
+        assert run(framer_type, chunks, limit) == args.packets
+        best = min(timeit.repeat(lambda: run(framer_type, chunks, limit), number=1, repeat=args.repeat))
+        print('{:<14}{:>10.2f} ms  {:>12.0f} packets/s'.format(name, best * 1000, args.packets / best))
+
+
+if __name__ == '__main__':
+    main()
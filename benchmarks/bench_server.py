@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks for the server's hot paths, run in-process against a TsuServer3 with fake transports.
+# The server is started in a temporary directory with a copy of config_sample, extended to 128
+# characters and with the packet flood guard relaxed, so no sockets or local config are needed.
+# Results can be saved as JSON and compared against an earlier run.
+# Run from the repository root: python benchmarks/bench_server.py [-o new.json] [--compare old.json]
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+REPOSITORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPOSITORY)
+
+import yaml
+
+from server import fantacrypt
+from server.aoprotocol import AOProtocol
+from server.constants import TargetType
+from server.tsuserver import TsuServer3
+
+CHARACTER_COUNT = 128
+
+
+class FakeTransport:
+    """
+    Transport that only counts what is written to it.
+    """
+    def __init__(self, ip):
+        self.ip = ip
+        self.written = 0
+        self.closed = False
+
+    def get_extra_info(self, key, default=None):
+        if key == 'peername':
+            return (self.ip, 50000)
+        return default
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    abort = close
+
+
+def make_fixture(directory):
+    """ Lays out a server directory with the sample configuration, adjusted for benchmarking. """
+    shutil.copytree(os.path.join(REPOSITORY, 'config_sample'), os.path.join(directory, 'config'))
+    os.mkdir(os.path.join(directory, 'logs'))
+    os.mkdir(os.path.join(directory, 'storage'))
+
+    with open(os.path.join(directory, 'config', 'characters.yaml'), 'r', encoding='utf-8') as chars:
+        char_list = yaml.safe_load(chars)
+    char_list += ['Bench Character {}'.format(i) for i in range(CHARACTER_COUNT - len(char_list))]
+    with open(os.path.join(directory, 'config', 'characters.yaml'), 'w', encoding='utf-8') as chars:
+        yaml.safe_dump(char_list, chars)
+
+    with open(os.path.join(directory, 'config', 'config.yaml'), 'r', encoding='utf-8') as cfg:
+        config = yaml.safe_load(cfg)
+    config['playerlimit'] = 1000
+    config['packet_floodguard'] = {'rate': 1e9, 'burst': 1e9, 'strikes_to_mute': 1e9,
+                                   'mute_length': 0, 'mutes_to_disconnect': 1e9}
+    with open(os.path.join(directory, 'config', 'config.yaml'), 'w', encoding='utf-8') as cfg:
+        yaml.safe_dump(config, cfg)
+
+
+class Bench:
+    """
+    A TsuServer3 with a number of connected clients, all sitting in the default area.
+    """
+    def __init__(self, client_count):
+        self.server = TsuServer3()
+        self.server.loop = asyncio.get_event_loop()
+        self.protocols = []
+        for i in range(client_count):
+            self.connect(i)
+        self.flush()
+
+    def connect(self, i):
+        protocol = AOProtocol(self.server)
+        protocol.connection_made(FakeTransport('10.0.{}.{}'.format(i // 250, i % 250 + 1)))
+        for packet in ('HI#bench{}#%'.format(i), 'ID#AO2#2.6.0#%', 'RD#%',
+                       'CC#0#{}#bench#%'.format(i % CHARACTER_COUNT), 'CT#bench{}#hello#%'.format(i)):
+            protocol.data_received(packet.encode('utf-8'))
+        self.protocols.append(protocol)
+
+    @property
+    def clients(self):
+        return [protocol.client for protocol in self.protocols]
+
+    def flush(self):
+        for protocol in self.protocols:
+            protocol.client.flush()
+
+    def close(self):
+        # Release the database so that the next benchmark's server can open it
+        self.server.storage.close()
+
+
+def bench_ms_fanout(client_count):
+    bench = Bench(client_count)
+    sender = bench.protocols[0]
+    client = sender.client
+    args = AOProtocol.net_cmd_schemas['MS'].validate(
+        ['chat', '-', client.get_char_name(), 'normal', 'benchmark message', 'wit', '0',
+         '0', str(client.char_id), '0', '0', '0', '0', '0', '0'])
+    area = client.area
+
+    def run():
+        area.next_message_time = 0 # Skip the IC message delay
+        sender.net_cmd_ms(args)
+        bench.flush()
+    return bench, run
+
+
+def bench_change_area():
+    bench = Bench(50)
+    client = bench.clients[0]
+    areas = [bench.server.area_manager.get_area_by_name('Basement'),
+             bench.server.area_manager.get_area_by_name('Class Trial Room 1')]
+
+    def run():
+        client.change_area(areas[1] if client.area == areas[0] else areas[0])
+        bench.flush()
+    return bench, run
+
+
+def bench_send_area_info():
+    bench = Bench(100)
+    client = bench.clients[0]
+    client.is_mod = True
+
+    def run():
+        client.send_area_info(client.area, -1, False)
+        bench.flush()
+    return bench, run
+
+
+def bench_get_targets():
+    bench = Bench(100)
+    client = bench.clients[0]
+    client_manager = bench.server.client_manager
+
+    def run():
+        client_manager.get_targets(client, TargetType.OOC_NAME, 'bench99', False)
+        client_manager.get_targets(client, TargetType.CHAR_NAME, 'Bench Character 50', False)
+        client_manager.get_targets(client, TargetType.ID, 99, False)
+    return bench, run
+
+
+def bench_build_music_list():
+    bench = Bench(1)
+    server = bench.server
+    client = bench.clients[0]
+
+    def run():
+        server.build_music_list_ao2(from_area=client.area, c=client)
+    return bench, run
+
+
+def bench_create_evi_list():
+    bench = Bench(1)
+    client = bench.clients[0]
+    evi_list = client.area.evi_list
+    for i in range(50):
+        evi_list.add_evidence(client, 'Evidence {}'.format(i), 'Description {}'.format(i), 'empty.png',
+                              ('all', 'def', 'pro')[i % 3])
+
+    def run():
+        evi_list.create_evi_list(client)
+    return bench, run
+
+
+def bench_fanta_decrypt():
+    cipher = fantacrypt.fanta_encrypt('MS')
+
+    def run():
+        fantacrypt.fanta_decrypt(cipher)
+    return None, run
+
+
+def bench_data_received():
+    bench = Bench(1)
+    protocol = bench.protocols[0]
+    # One read carrying a pipelined burst of keepalives
+    data = b'CH#0#%' * 100
+
+    def run():
+        protocol.data_received(data)
+        bench.flush()
+    return bench, run
+
+
+BENCHMARKS = [
+    ('net_cmd_ms fan-out, 10 clients', lambda: bench_ms_fanout(10)),
+    ('net_cmd_ms fan-out, 50 clients', lambda: bench_ms_fanout(50)),
+    ('net_cmd_ms fan-out, 100 clients', lambda: bench_ms_fanout(100)),
+    ('Client.change_area', bench_change_area),
+    ('send_area_info(-1), 100 clients', bench_send_area_info),
+    ('get_targets x3, 100 clients', bench_get_targets),
+    ('build_music_list_ao2', bench_build_music_list),
+    ('create_evi_list, 50 evidence', bench_create_evi_list),
+    ('fanta_decrypt', bench_fanta_decrypt),
+    ('data_received, 100 packets', bench_data_received),
+]
+
+
+def time_benchmark(run, repeat, min_time):
+    """ Returns the best time per call in seconds, calibrating the number of calls per run. """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(run, number=number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    return min([elapsed] + timeit.repeat(run, number=number, repeat=repeat - 1)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the server hot paths in-process.')
+    parser.add_argument('-k', '--filter', help='only run benchmarks whose name contains this text')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed runs')
+    parser.add_argument('-t', '--min-time', type=float, default=0.2, help='minimum seconds per timed run')
+    parser.add_argument('-o', '--output', help='file to write the results to, as JSON')
+    parser.add_argument('-c', '--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    baseline = dict()
+    if args.compare:
+        with open(args.compare, 'r') as results:
+            baseline = json.load(results)['results']
+
+    results = dict()
+    working_directory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='tsuserver-bench-')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        make_fixture(directory)
+        os.chdir(directory)
+        for name, setup in BENCHMARKS:
+            if args.filter and args.filter not in name:
+                continue
+            # Keep the server's startup messages out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                bench, run = setup()
+            try:
+                seconds = time_benchmark(run, args.repeat, args.min_time)
+            finally:
+                if bench is not None:
+                    bench.close()
+            results[name] = seconds * 1e6
+            line = '{:<36}{:>12.2f} us/call'.format(name, results[name])
+            if name in baseline:
+                line += '  {:>6.2f}x vs baseline ({:.2f} us)'.format(baseline[name] / results[name], baseline[name])
+            print(line)
+    finally:
+        os.chdir(working_directory)
+        loop.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'unit': 'us/call', 'python': sys.version.split()[0], 'results': results},
+                      output, indent=2, sort_keys=True)
+            output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
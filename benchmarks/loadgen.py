@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Load generator for a running server.
+# Connects scripted AO2 clients to a local server (start_server.py with `local: true`), has them
+# go through the join handshake and then send a mix of IC messages, OOC messages, area changes
+# and OOC commands, and writes throughput and latency figures as JSON.
+# The packet flood guard limits in config.yaml apply to these clients as to any other, so raise
+# them for the run if the point is to measure the server rather than the flood guard.
+# Run from the repository root: python benchmarks/loadgen.py --clients 100 --duration 60 --output load.json
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import packets
+
+AREA_ENTRY = re.compile(r'^\d+-')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class ProcessStats:
+    """
+    CPU time and resident memory of the server process, read from /proc (Linux only).
+    """
+    def __init__(self, pid):
+        self.pid = pid
+
+    def cpu_time(self):
+        with open('/proc/{}/stat'.format(self.pid)) as stat:
+            # Skip the process name, which may contain spaces
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def rss_kb(self):
+        with open('/proc/{}/status'.format(self.pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        return None
+
+
+class LoadStats:
+    def __init__(self):
+        self.sent = dict()
+        self.frames_received = 0
+        self.handshake_times = []
+        self.latencies = []
+        self.failed_handshakes = 0
+        self.disconnects = 0
+
+    def count_sent(self, kind):
+        self.sent[kind] = self.sent.get(kind, 0) + 1
+
+
+class LoadClient:
+    """
+    One scripted AO2 client.
+    """
+    def __init__(self, index, options, stats):
+        self.index = index
+        self.options = options
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.framer = packets.PacketFramer(limit=1 << 30)
+        self.waiters = dict()
+        self.client_id = None
+        self.char_list = []
+        self.free_chars = []
+        self.areas = []
+        self.songs = []
+        self.char_id = -1
+        self.name = 'loadgen{}'.format(index)
+
+    def send(self, command, *args):
+        self.writer.write(packets.build_command(command, *args))
+
+    def expect(self, command):
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(command, []).append(future)
+        return future
+
+    async def read_loop(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                self.stats.disconnects += 1
+                return
+            self.framer.feed(data)
+            now = time.perf_counter()
+            for msg in self.framer.get_messages():
+                self.stats.frames_received += 1
+                self.handle(msg.split('#'), now)
+
+    def handle(self, args, now):
+        command = args[0]
+        if command == 'ID':
+            self.client_id = args[1]
+        elif command == 'SC':
+            self.char_list = args[1:]
+        elif command == 'SM':
+            entries = args[1:]
+            self.areas = [entry for entry in entries if AREA_ENTRY.match(entry)]
+            self.songs = [entry for entry in entries if '.' in entry and not AREA_ENTRY.match(entry)]
+        elif command == 'CharsCheck':
+            self.free_chars = [char_id for char_id, taken in enumerate(args[1:]) if taken == '0']
+        elif command == 'PV':
+            self.char_id = int(args[3])
+        elif command in ('MS', 'CT'):
+            # Messages sent by load clients carry the time they were sent at
+            text = args[5] if command == 'MS' else args[2]
+            if text.startswith('lg '):
+                self.stats.latencies.append(now - float(text.split(' ')[1]))
+        for future in self.waiters.pop(command, []):
+            if not future.done():
+                future.set_result(args)
+
+    async def handshake(self):
+        timeout = self.options.timeout
+        hello = self.expect('ID')
+        self.send('HI', 'loadgen-hdid-{}'.format(self.index))
+        await asyncio.wait_for(hello, timeout)
+        self.send('ID', 'AO2', '2.6.0')
+        counts = self.expect('SI')
+        self.send('askchaa')
+        await asyncio.wait_for(counts, timeout)
+        chars = self.expect('SC')
+        self.send('RC')
+        await asyncio.wait_for(chars, timeout)
+        music = self.expect('SM')
+        self.send('RM')
+        await asyncio.wait_for(music, timeout)
+        done = self.expect('DONE')
+        self.send('RD')
+        await asyncio.wait_for(done, timeout)
+
+        # Pick a free character, falling back to spectating if every attempt is taken by someone faster
+        candidates = list(self.free_chars)
+        random.shuffle(candidates)
+        for char_id in candidates[:3]:
+            selected = self.expect('PV')
+            self.send('CC', self.client_id, char_id, 'loadgen-hdid-{}'.format(self.index))
+            try:
+                await asyncio.wait_for(selected, timeout)
+                break
+            except asyncio.TimeoutError:
+                continue
+
+    def act(self):
+        kind = random.choices(self.options.mix_kinds, weights=self.options.mix_weights)[0]
+        stamp = 'lg {:.6f} {}'.format(time.perf_counter(), self.index)
+        if kind == 'ms':
+            if self.char_id < 0:
+                kind = 'ct'
+            else:
+                self.send('MS', 'chat', '-', self.char_list[self.char_id], 'normal', stamp, 'wit', '0',
+                          0, self.char_id, 0, 0, 0, 0, 0, 0)
+        if kind == 'ct':
+            self.send('CT', self.name, stamp)
+        elif kind == 'area':
+            if self.areas:
+                self.send('MC', random.choice(self.areas), self.char_id)
+        elif kind == 'music':
+            if self.songs:
+                self.send('MC', random.choice(self.songs), self.char_id)
+        elif kind == 'cmd':
+            self.send('CT', self.name, random.choice(self.options.commands))
+        self.stats.count_sent(kind)
+
+    async def run(self, deadline):
+        start = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.options.host, self.options.port), self.options.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.stats.failed_handshakes += 1
+            return
+        reading = asyncio.ensure_future(self.read_loop())
+        try:
+            await self.handshake()
+        except asyncio.TimeoutError:
+            self.stats.failed_handshakes += 1
+            reading.cancel()
+            self.writer.close()
+            return
+        self.stats.handshake_times.append(time.perf_counter() - start)
+
+        interval = 1 / self.options.rate
+        last_check = time.perf_counter()
+        while time.perf_counter() < deadline and not reading.done():
+            # Spread actions out randomly so clients do not all act in lockstep
+            await asyncio.sleep(random.expovariate(1 / interval))
+            self.act()
+            if time.perf_counter() - last_check > 5:
+                self.send('CH', self.client_id)
+                last_check = time.perf_counter()
+        reading.cancel()
+        self.writer.close()
+
+
+async def run_load(options):
+    stats = LoadStats()
+    clients = [LoadClient(i, options, stats) for i in range(options.clients)]
+    server = ProcessStats(options.server_pid) if options.server_pid else None
+    cpu_start = server.cpu_time() if server else None
+
+    start = time.perf_counter()
+    deadline = start + options.ramp + options.duration
+    tasks = []
+    for client in clients:
+        tasks.append(asyncio.ensure_future(client.run(deadline)))
+        await asyncio.sleep(options.ramp / max(options.clients, 1))
+    # Only the part after every client connected counts towards throughput
+    measure_start = time.perf_counter()
+    frames_start = stats.frames_received
+    sent_start = sum(stats.sent.values())
+    latencies_start = len(stats.latencies)
+    await asyncio.gather(*tasks)
+    elapsed = max(time.perf_counter() - measure_start, 1e-9)
+
+    latencies = stats.latencies[latencies_start:]
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': {key: value for key, value in vars(options).items()
+                    if key not in ('mix_kinds', 'mix_weights')},
+        'clients_connected': len(stats.handshake_times),
+        'failed_handshakes': stats.failed_handshakes,
+        'disconnects': stats.disconnects,
+        'handshake_p50_ms': percentile(stats.handshake_times, 0.5),
+        'handshake_p99_ms': percentile(stats.handshake_times, 0.99),
+        'elapsed_s': elapsed,
+        'sent': stats.sent,
+        'sent_per_s': (sum(stats.sent.values()) - sent_start) / elapsed,
+        'received_frames_per_s': (stats.frames_received - frames_start) / elapsed,
+        'fanout_deliveries': len(latencies),
+        'fanout_p50_ms': percentile(latencies, 0.5),
+        'fanout_p99_ms': percentile(latencies, 0.99),
+        'fanout_max_ms': max(latencies) if latencies else None,
+        'server_cpu_percent': None,
+        'server_rss_kb': None,
+    }
+    for key in ('handshake_p50_ms', 'handshake_p99_ms', 'fanout_p50_ms', 'fanout_p99_ms', 'fanout_max_ms'):
+        if result[key] is not None:
+            result[key] *= 1000
+    if server:
+        result['server_cpu_percent'] = (server.cpu_time() - cpu_start) / (time.perf_counter() - start) * 100
+        result['server_rss_kb'] = server.rss_kb()
+    return result
+
+
+def parse_mix(mix):
+    kinds, weights = [], []
+    for entry in mix.split(','):
+        kind, weight = entry.split('=')
+        if kind not in ('ms', 'ct', 'area', 'music', 'cmd'):
+            raise argparse.ArgumentTypeError('Unknown action {}.'.format(kind))
+        kinds.append(kind)
+        weights.append(float(weight))
+    return kinds, weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate load against a local server.')
+    parser.add_argument('--host', default='127.0.0.1', help='server address')
+    parser.add_argument('--port', type=int, default=50000, help='server port')
+    parser.add_argument('-c', '--clients', type=int, default=50, help='number of clients')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='seconds to run after every client connected')
+    parser.add_argument('--ramp', type=float, default=5, help='seconds over which clients connect')
+    parser.add_argument('--rate', type=float, default=0.5, help='actions per second per client')
+    parser.add_argument('--mix', default='ms=5,ct=2,area=1,music=1,cmd=1',
+                        help='relative weights of the actions ms, ct, area, music and cmd')
+    parser.add_argument('--commands', default='/online,/getarea,/minimap',
+                        help='comma-separated OOC commands used by the cmd action')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for each handshake reply')
+    parser.add_argument('--server-pid', type=int, help='server process ID, to report its CPU and memory use')
+    parser.add_argument('--seed', type=int, help='random seed, for repeatable action sequences')
+    parser.add_argument('-o', '--output', help='file to write the JSON results to (default: standard output)')
+    options = parser.parse_args()
+    options.mix_kinds, options.mix_weights = parse_mix(options.mix)
+    options.commands = options.commands.split(',')
+    if options.seed is not None:
+        random.seed(options.seed)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(run_load(options))
+    finally:
+        loop.close()
+
+    report = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
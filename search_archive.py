@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Searches the chat archive offline, e.g. while the server is down or from a copy of storage/archive.
+# Usage: python search_archive.py [--ipid IPID] [--area AREA] [--since TIME] [--until TIME] [--kind KIND] [text]
+
+import argparse
+
+from server.chat_archive import ChatArchive, format_event, parse_time
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the chat archive.')
+    parser.add_argument('text', nargs='*', help='exact phrase the message must contain')
+    parser.add_argument('--ipid', type=int, help='IPID of the sender')
+    parser.add_argument('--area', type=int, help='ID of the area the event happened in')
+    parser.add_argument('--since', type=parse_time, help='start of the time range, e.g. 12h, 7d, 2019-06-22 or 2019-06-22T18:30 (UTC)')
+    parser.add_argument('--until', type=parse_time, help='end of the time range, same formats as --since')
+    parser.add_argument('--kind', choices=('IC', 'OOC', 'music', 'judge'), help='kind of event')
+    parser.add_argument('--limit', type=int, default=100, help='maximum number of results (default: 100)')
+    parser.add_argument('--directory', default='storage/archive', help='archive directory (default: storage/archive)')
+    args = parser.parse_args()
+
+    archive = ChatArchive(args.directory)
+    events = archive.search(ipid=args.ipid, area=args.area, since=args.since, until=args.until, kind=args.kind,
+                            text=' '.join(args.text), limit=args.limit)
+    for event in reversed(events):
+        print(format_event(event))
+
+if __name__ == '__main__':
+    main()
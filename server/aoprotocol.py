@@ -21,9 +21,10 @@ import sys
 import traceback
 
 from time import localtime, strftime, time, asctime
-from enum import Enum
 
 from server import logger
+from server import packets
+from server.packets import ArgType, AtLeast, NetCommandSchema
 from server.exceptions import ClientError, AreaError, ArgumentError, ServerError
 from server.fantacrypt import fanta_decrypt
 from server.evidence import EvidenceList
@@ -33,16 +34,11 @@ class AOProtocol(asyncio.Protocol):
     The main class that deals with the AO protocol.
     """
 
-    class ArgType(Enum):
-        STR = 1,
-        STR_OR_EMPTY = 2,
-        INT = 3
-
     def __init__(self, server):
         super().__init__()
         self.server = server
         self.client = None
-        self.buffer = ''
+        self.framer = packets.PacketFramer()
         self.ping_timeout = None
 
         # Determine whether /exec is active or not and warn server owner if so.
@@ -68,9 +64,7 @@ class AOProtocol(asyncio.Protocol):
 
         :param data: bytes of data
         """
-        # try to decode as utf-8, ignore any erroneous characters
-        self.buffer += data.decode('utf-8', 'ignore')
-        if len(self.buffer) > 8192:
+        if not self.framer.feed(data):
             self.client.disconnect()
         for msg in self.get_messages():
             if len(msg) < 2:
@@ -82,10 +76,16 @@ class AOProtocol(asyncio.Protocol):
                     msg = msg[1:]
                 spl = msg.split('#', 1)
                 msg = '#'.join([fanta_decrypt(spl[0])] + spl[1:])
-                logger.log_debug('[INC][RAW]{}'.format(msg), self.client)
+                logger.log_debug('[INC][RAW]{}', self.client, msg)
             try:
                 cmd, *args = msg.split('#')
-                self.net_cmd_dispatcher[cmd](self, args)
+                if not self.server.flood_guard.allow(self.client, cmd, known=cmd in self.net_cmd_schemas):
+                    continue
+                validated_args = self.net_cmd_schemas[cmd].validate(args)
+                if validated_args is None:
+                    logger.log_debug('[INC][REJECTED]{}', self.client, msg)
+                    continue
+                self.net_cmd_dispatcher[cmd](self, validated_args)
             except Exception as ex:
                 # Send basic logging information to user
                 info = '=========\nThe server ran into a Python issue. Please contact the server owner and send them the following logging information:'
@@ -121,8 +121,15 @@ class AOProtocol(asyncio.Protocol):
 
         :param transport: the transport object
         """
-        self.client = self.server.new_client(transport)
-        self.ping_timeout = asyncio.get_event_loop().call_later(self.server.config['timeout'], self.client.disconnect)
+        try:
+            self.client = self.server.new_client(transport)
+        except ServerError as ex:
+            logger.log_print('Refused connection from {}: {}'.format(transport.get_extra_info('peername')[0], ex))
+            transport.close()
+            return
+        output_limits = self.server.config['output_buffer']
+        transport.set_write_buffer_limits(high=output_limits['high_watermark'], low=output_limits['low_watermark'])
+        self.ping_timeout = self.server.timer_manager.schedule(self.server.config['timeout'], self.client.disconnect)
         self.client.send_command('decryptor', 34)  # just fantacrypt things
 
     def connection_lost(self, exc):
@@ -130,45 +137,25 @@ class AOProtocol(asyncio.Protocol):
 
         :param exc: reason
         """
+        if self.client is None: # Connection was refused
+            return
         self.server.remove_client(self.client)
         self.ping_timeout.cancel()
 
+    def pause_writing(self):
+        """ The transport buffer passed its high watermark. """
+        self.client.pause_writing()
+
+    def resume_writing(self):
+        """ The transport buffer drained below its low watermark. """
+        self.client.resume_writing()
+
     def get_messages(self):
         """ Parses out full messages from the buffer.
 
-        :return: yields messages
+        :return: list of messages
         """
-        while '#%' in self.buffer:
-            spl = self.buffer.split('#%', 1)
-            self.buffer = spl[1]
-            yield spl[0]
-        # exception because bad netcode
-        askchar2 = '#615810BC07D12A5A#'
-        if self.buffer == askchar2:
-            self.buffer = ''
-            yield askchar2
-
-    def validate_net_cmd(self, args, *types, needs_auth=True):
-        """ Makes sure the net command's arguments match expectations.
-
-        :param args: actual arguments to the net command
-        :param types: what kind of data types are expected
-        :param needs_auth: whether you need to have chosen a character
-        :return: returns True if message was validated
-        """
-        if needs_auth and self.client.char_id == -1:
-            return False
-        if len(args) != len(types):
-            return False
-        for i, arg in enumerate(args):
-            if len(arg) == 0 and types[i] != self.ArgType.STR_OR_EMPTY:
-                return False
-            if types[i] == self.ArgType.INT:
-                try:
-                    args[i] = int(arg)
-                except ValueError:
-                    return False
-        return True
+        return self.framer.get_messages()
 
     def net_cmd_hi(self, args):
         """ Handshake.
@@ -177,15 +164,9 @@ class AOProtocol(asyncio.Protocol):
 
         :param args: a list containing all the arguments
         """
-        if not self.validate_net_cmd(args, self.ArgType.STR, needs_auth=False):
-            return
         self.client.hdid = args[0]
-        if self.client.hdid not in self.client.server.hdid_list:
-            self.client.server.hdid_list[self.client.hdid] = []
-        if self.client.ipid not in self.client.server.hdid_list[self.client.hdid]:
-            self.client.server.hdid_list[self.client.hdid].append(self.client.ipid)
-            self.client.server.dump_hdids()
-        for ipid in self.client.server.hdid_list[self.client.hdid]:
+        self.server.storage.add_hdid(self.client.hdid, self.client.ipid)
+        for ipid in self.server.storage.get_hdid_ipids(self.client.hdid):
             if self.server.ban_manager.is_banned(ipid):
                 self.client.disconnect()
                 return
@@ -202,9 +183,6 @@ class AOProtocol(asyncio.Protocol):
 
         self.client.is_ao2 = False
 
-        if len(args) < 2:
-            return
-
         version_list = args[1].split('.')
 
         if len(version_list) < 3:
@@ -235,9 +213,8 @@ class AOProtocol(asyncio.Protocol):
         CHECK#%
 
         """
-        self.client.send_command('CHECK')
-        self.ping_timeout.cancel()
-        self.ping_timeout = asyncio.get_event_loop().call_later(self.server.config['timeout'], self.client.disconnect)
+        self.client.send_command('CHECK', flush=True) # The client measures its ping with this
+        self.ping_timeout.reschedule(self.server.config['timeout'])
 
     def net_cmd_askchaa(self, _):
         """ Ask for the counts of characters/evidence/music
@@ -264,8 +241,6 @@ class AOProtocol(asyncio.Protocol):
         AN#<page:int>#%
 
         """
-        if not self.validate_net_cmd(args, self.ArgType.INT, needs_auth=False):
-            return
         if len(self.server.char_pages_ao1) > args[0] >= 0:
             self.client.send_command('CI', *self.server.char_pages_ao1[args[0]])
         else:
@@ -285,8 +260,6 @@ class AOProtocol(asyncio.Protocol):
         AM#<page:int>#%
 
         """
-        if not self.validate_net_cmd(args, self.ArgType.INT, needs_auth=False):
-            return
         if len(self.server.music_pages_ao1) > args[0] >= 0:
             self.client.send_command('EM', *self.server.music_pages_ao1[args[0]])
         else:
@@ -312,8 +285,7 @@ class AOProtocol(asyncio.Protocol):
         # Force the server to rebuild the music list, so that clients who just
         # join get the correct music list (as well as every time they request
         # an updated music list directly).
-        self.server.build_music_list_ao2()
-        self.client.send_command('SM', *self.server.music_list_ao2)
+        self.client.send_frame(self.server.get_music_list_frame('SM'))
 
 
     def net_cmd_rd(self, _):
@@ -339,10 +311,7 @@ class AOProtocol(asyncio.Protocol):
         CC#<client_id:int>#<char_id:int>#<hdid:string>#%
 
         """
-        if not self.validate_net_cmd(args, self.ArgType.INT, self.ArgType.INT, self.ArgType.STR,
-                                     needs_auth=False):
-            return
-        cid = args[1]
+        cid = args.char_id
         try:
             self.client.change_character(cid)
         except ClientError:
@@ -362,11 +331,7 @@ class AOProtocol(asyncio.Protocol):
             return
         if not self.client.area.can_send_message():
             return
-        if not self.validate_net_cmd(args, self.ArgType.STR, self.ArgType.STR_OR_EMPTY, self.ArgType.STR,
-                                     self.ArgType.STR,
-                                     self.ArgType.STR, self.ArgType.STR, self.ArgType.STR, self.ArgType.INT,
-                                     self.ArgType.INT, self.ArgType.INT, self.ArgType.INT, self.ArgType.INT,
-                                     self.ArgType.INT, self.ArgType.INT, self.ArgType.INT):
+        if self.client.char_id == -1:
             return
         msg_type, pre, folder, anim, text, pos, sfx, anim_type, cid, sfx_delay, button, evidence, flip, ding, color = args
         if self.client.area.is_iniswap(self.client, pre, anim, folder) and folder != self.client.get_char_name():
@@ -375,22 +340,8 @@ class AOProtocol(asyncio.Protocol):
         if folder in self.client.area.restricted_chars and not self.client.is_staff():
             self.client.send_host_message('Your character is restricted in the current area.')
             return
-        if msg_type not in ('chat', '0', '1'):
-            return
-        if anim_type not in (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10):
-            return
         if cid != self.client.char_id:
             return
-        if sfx_delay < 0:
-            return
-        if button not in (0, 1, 2, 3, 4, 5, 6, 7): # Shouts
-            return
-        if evidence < 0:
-            return
-        if ding not in (0, 1, 2, 3, 4, 5, 6, 7): # Effects
-            return
-        if color not in (0, 1, 2, 3, 4, 5, 6):
-            return
         if color == 5 and not self.client.is_mod and not self.client.is_cm:
             color = 0
         if color == 6:
@@ -420,30 +371,37 @@ class AOProtocol(asyncio.Protocol):
                 self.client.area.evi_list.evidences[self.client.evi_list[evidence] - 1].pos = 'all'
                 self.client.area.broadcast_evidence_list()
 
-        if self.client.multi_ic is None:
-            for c in self.client.area.clients:
-                if c.show_shownames:
-                    showname = self.client.showname
-                else:
-                    showname = ''
-
-                c.send_command('MS', msg_type, pre, folder, anim, msg, pos, sfx, anim_type, cid,
-                               sfx_delay, button, self.client.evi_list[evidence], flip, ding, color, showname)
-        else:
-            for area_id in range(self.client.multi_ic[0].id, self.client.multi_ic[1].id + 1):
-                target_area = self.server.area_manager.get_area_by_id(area_id)
-                for c in target_area.clients:
+        # Recipients only differ in whether they see shownames and in where the evidence sits in
+        # their own evidence list, so build each of those variants once and reuse the frame.
+        evidence_id = self.client.evi_list[evidence]
+        frames = dict()
+
+        def send_ic(clients):
+            for c in clients:
+                variant = (c.show_shownames, c.get_evidence_index(evidence_id))
+                try:
+                    frame = frames[variant]
+                except KeyError:
                     if c.show_shownames:
                         showname = self.client.showname
                     else:
                         showname = ''
+                    frame = packets.build_command('MS', msg_type, pre, folder, anim, msg, pos, sfx,
+                                                  anim_type, cid, sfx_delay, button, variant[1],
+                                                  flip, ding, color, showname)
+                    frames[variant] = frame
+                c.send_frame(frame)
 
-                    c.send_command('MS', msg_type, pre, folder, anim, msg, pos, sfx, anim_type, cid,
-                                   sfx_delay, button, self.client.evi_list[evidence], flip, ding, color, showname)
+        if self.client.multi_ic is None:
+            send_ic(self.client.area.clients)
+        else:
+            for target_area in self.client.multi_ic_areas:
+                send_ic(target_area.clients)
                 target_area.set_next_msg_delay(len(msg))
 
         self.client.area.set_next_msg_delay(len(msg))
-        logger.log_server('[IC][{}][{}]{}'.format(self.client.area.id, self.client.get_char_name(), msg), self.client)
+        logger.log_server('[IC][{}][{}]{}', self.client, self.client.area.id, self.client.get_char_name(), msg)
+        logger.log_archive('IC', self.client, msg)
 
         # Sending IC messages reveals sneaked players
         if not self.client.is_staff() and not self.client.is_visible:
@@ -462,8 +420,6 @@ class AOProtocol(asyncio.Protocol):
         if self.client.is_ooc_muted:  # Checks to see if the client has been muted by a mod
             self.client.send_host_message("You have been muted by a moderator.")
             return
-        if not self.validate_net_cmd(args, self.ArgType.STR, self.ArgType.STR, needs_auth=False):
-            return
         if self.client.name != args[0] and self.client.fake_name != args[0]:
             if self.client.is_valid_name(args[0]):
                 self.client.name = args[0]
@@ -500,17 +456,18 @@ class AOProtocol(asyncio.Protocol):
                 except Exception:
                     raise # Explicit raising, even though not needed
         else:
+            message = args[1]
             if self.client.disemvowel: #If you are disemvoweled, replace string.
-                args[1] = self.client.disemvowel_message(args[1])
+                message = self.client.disemvowel_message(message)
             if self.client.disemconsonant: #If you are disemconsonanted, replace string.
-                args[1] = self.client.disemconsonant_message(args[1])
+                message = self.client.disemconsonant_message(message)
             if self.client.remove_h: #If h is removed, replace string.
-                args[1] = self.client.remove_h_message(args[1])
+                message = self.client.remove_h_message(message)
 
-            self.client.area.send_command('CT', self.client.name, args[1])
-            logger.log_server(
-                '[OOC][{}][{}][{}]{}'.format(self.client.area.id, self.client.get_char_name(), self.client.name,
-                                             args[1]), self.client)
+            self.client.area.send_command('CT', self.client.name, message)
+            logger.log_server('[OOC][{}][{}][{}]{}', self.client,
+                              self.client.area.id, self.client.get_char_name(), self.client.name, message)
+            logger.log_archive('OOC', self.client, message)
 
     def net_cmd_mc(self, args):
         """ Play music.
@@ -532,7 +489,7 @@ class AOProtocol(asyncio.Protocol):
             if not self.client.is_dj:
                 self.client.send_host_message('You were blockdj\'d by a moderator.')
                 return
-            if not self.validate_net_cmd(args, self.ArgType.STR, self.ArgType.INT):
+            if self.client.char_id == -1:
                 return
             if args[1] != self.client.char_id:
                 return
@@ -545,8 +502,9 @@ class AOProtocol(asyncio.Protocol):
                 self.client.area.play_music(name, self.client.char_id, length)
                 self.client.area.add_music_playing(self.client, name)
 
-                logger.log_server('[{}][{}]Changed music to {}.'
-                                  .format(self.client.area.id, self.client.get_char_name(), name), self.client)
+                logger.log_server('[{}][{}]Changed music to {}.', self.client,
+                                  self.client.area.id, self.client.get_char_name(), name)
+                logger.log_archive('music', self.client, name)
 
                 # Changing music reveals sneaked players
                 if not self.client.is_staff() and not self.client.is_visible:
@@ -566,13 +524,12 @@ class AOProtocol(asyncio.Protocol):
         if self.client.is_muted:  # Checks to see if the client has been muted by a mod
             self.client.send_host_message("You have been muted by a moderator")
             return
-        if not self.validate_net_cmd(args, self.ArgType.STR):
-            return
-        if args[0] not in ('testimony1', 'testimony2', 'testimony3', 'testimony4'):
+        if self.client.char_id == -1:
             return
         self.client.area.send_command('RT', args[0])
         self.client.area.add_to_judgelog(self.client, 'used judge button {}.'.format(args[0]))
-        logger.log_server("[{}]{} used judge button {}.".format(self.client.area.id, self.client.get_char_name(), args[0]), self.client)
+        logger.log_server('[{}]{} used judge button {}.', self.client, self.client.area.id, self.client.get_char_name(), args[0])
+        logger.log_archive('judge', self.client, 'used judge button {}'.format(args[0]))
 
     def net_cmd_hp(self, args):
         """ Sets the penalty bar.
@@ -583,13 +540,14 @@ class AOProtocol(asyncio.Protocol):
         if self.client.is_muted:  # Checks to see if the client has been muted by a mod
             self.client.send_host_message("You have been muted by a moderator")
             return
-        if not self.validate_net_cmd(args, self.ArgType.INT, self.ArgType.INT):
+        if self.client.char_id == -1:
             return
         try:
             self.client.area.change_hp(args[0], args[1])
             self.client.area.add_to_judgelog(self.client, 'changed the penalties')
-            logger.log_server('[{}]{} changed HP ({}) to {}'
-                              .format(self.client.area.id, self.client.get_char_name(), args[0], args[1]), self.client)
+            logger.log_server('[{}]{} changed HP ({}) to {}', self.client,
+                              self.client.area.id, self.client.get_char_name(), args[0], args[1])
+            logger.log_archive('judge', self.client, 'changed HP ({}) to {}'.format(args[0], args[1]))
         except AreaError:
             return
 
@@ -599,8 +557,6 @@ class AOProtocol(asyncio.Protocol):
         PE#<name: string>#<description: string>#<image: string>#%
 
         """
-        if len(args) < 3:
-            return
 #        evi = Evidence(args[0], args[1], args[2], self.client.pos)
         self.client.area.evi_list.add_evidence(self.client, args[0], args[1], args[2], 'all')
         self.client.area.broadcast_evidence_list()
@@ -612,7 +568,7 @@ class AOProtocol(asyncio.Protocol):
 
         """
 
-        self.client.area.evi_list.del_evidence(self.client, self.client.evi_list[int(args[0])])
+        self.client.area.evi_list.del_evidence(self.client, self.client.evi_list[args[0]])
         self.client.area.broadcast_evidence_list()
 
     def net_cmd_ee(self, args):
@@ -622,12 +578,9 @@ class AOProtocol(asyncio.Protocol):
 
         """
 
-        if len(args) < 4:
-            return
-
         evi = (args[1], args[2], args[3], 'all')
 
-        self.client.area.evi_list.edit_evidence(self.client, self.client.evi_list[int(args[0])], evi)
+        self.client.area.evi_list.edit_evidence(self.client, self.client.evi_list[args[0]], evi)
         self.client.area.broadcast_evidence_list()
 
     def net_cmd_zz(self, _):
@@ -644,9 +597,9 @@ class AOProtocol(asyncio.Protocol):
 
         current_time = strftime("%H:%M", localtime())
 
-        self.server.send_all_cmd_pred('ZZ', '[{}] {} ({}) in {} ({})'
-                                      .format(current_time, self.client.get_char_name(), self.client.get_ip(), self.client.area.name,
-                                              self.client.area.id), pred=lambda c: c.is_mod)
+        self.server.send_all_cmd_set(self.server.client_manager.mods, 'ZZ', '[{}] {} ({}) in {} ({})'
+                                     .format(current_time, self.client.get_char_name(), self.client.get_ip(), self.client.area.name,
+                                             self.client.area.id))
         self.client.set_mod_call_delay()
         logger.log_server('[{}][{}]{} called a moderator.'.format(self.client.get_ip(), self.client.area.id, self.client.get_char_name()))
 
@@ -681,3 +634,49 @@ class AOProtocol(asyncio.Protocol):
         'opKICK': net_cmd_opKICK,  # /kick with guard on
         'opBAN': net_cmd_opBAN,  # /ban with guard on
     }
+
+    # Arguments every net command must carry, checked before the packet reaches its handler.
+    # Packets that do not match are dropped and counted in the schema's rejected counter.
+    net_cmd_schemas = {schema.command: schema for schema in (
+        NetCommandSchema('HI', ('hdid', ArgType.STR)),
+        NetCommandSchema('ID', ('software', ArgType.STR_OR_EMPTY), ('version', ArgType.STR_OR_EMPTY),
+                         extra_args=True),
+        NetCommandSchema('CH', extra_args=True),
+        NetCommandSchema('askchaa', extra_args=True),
+        NetCommandSchema('askchar2', extra_args=True),
+        NetCommandSchema('AN', ('page', ArgType.INT)),
+        NetCommandSchema('AE', extra_args=True),
+        NetCommandSchema('AM', ('page', ArgType.INT)),
+        NetCommandSchema('RC', extra_args=True),
+        NetCommandSchema('RM', extra_args=True),
+        NetCommandSchema('RD', extra_args=True),
+        NetCommandSchema('CC', ('client_id', ArgType.INT), ('char_id', ArgType.INT), ('hdid', ArgType.STR)),
+        NetCommandSchema('MS',
+                         ('msg_type', ArgType.STR, ('chat', '0', '1')),
+                         ('pre', ArgType.STR_OR_EMPTY),
+                         ('folder', ArgType.STR),
+                         ('anim', ArgType.STR),
+                         ('text', ArgType.STR),
+                         ('pos', ArgType.STR),
+                         ('sfx', ArgType.STR),
+                         ('anim_type', ArgType.INT, range(0, 11)),
+                         ('cid', ArgType.INT),
+                         ('sfx_delay', ArgType.INT, AtLeast(0)),
+                         ('button', ArgType.INT, range(0, 8)), # Shouts
+                         ('evidence', ArgType.INT, AtLeast(0)),
+                         ('flip', ArgType.INT),
+                         ('ding', ArgType.INT, range(0, 8)), # Effects
+                         ('color', ArgType.INT, range(0, 7))),
+        NetCommandSchema('CT', ('name', ArgType.STR), ('message', ArgType.STR)),
+        NetCommandSchema('MC', ('name', ArgType.STR), ('char_id', ArgType.INT), extra_args=True),
+        NetCommandSchema('RT', ('animation', ArgType.STR, ('testimony1', 'testimony2', 'testimony3', 'testimony4'))),
+        NetCommandSchema('HP', ('side', ArgType.INT, range(1, 3)), ('value', ArgType.INT, range(0, 11))),
+        NetCommandSchema('PE', ('name', ArgType.STR_OR_EMPTY), ('description', ArgType.STR_OR_EMPTY),
+                         ('image', ArgType.STR_OR_EMPTY), extra_args=True),
+        NetCommandSchema('DE', ('evidence_id', ArgType.INT), extra_args=True),
+        NetCommandSchema('EE', ('evidence_id', ArgType.INT), ('name', ArgType.STR_OR_EMPTY),
+                         ('description', ArgType.STR_OR_EMPTY), ('image', ArgType.STR_OR_EMPTY), extra_args=True),
+        NetCommandSchema('ZZ', extra_args=True),
+        NetCommandSchema('opKICK', ('target', ArgType.STR_OR_EMPTY), extra_args=True),
+        NetCommandSchema('opBAN', ('target', ArgType.STR_OR_EMPTY), extra_args=True),
+    )}
@@ -20,6 +20,8 @@ import random
 import time
 import yaml
 
+from collections import Counter
+from server import packets
 from server.exceptions import AreaError
 from server.evidence import EvidenceList
 
@@ -28,6 +30,7 @@ class AreaManager:
     class Area:
         def __init__(self, area_id, server, parameters):
             self.clients = set()
+            self.char_occupancy = Counter()
             self.invite_list = {}
             self.id = area_id
             self.server = server
@@ -50,6 +53,20 @@ class AreaManager:
             self.is_modlocked = False
             self.bleeds_to = set()
             self.lights = True
+            self._sorted_reachable_areas = None
+            self._scream_areas = None
+            self.join_bundles = dict()
+            self.join_bundle_version = 0
+            self.rosters = dict()
+            self.roster_version = 0
+            # Population counters, kept up to date by count_client
+            self.player_count = 0 # Clients past the server selection screen
+            self.visible_player_count = 0
+            self.visible_count = 0
+            self.spectator_count = 0
+            self.bleeding_count = 0
+            self.cm_count = 0
+            self.staff_count = 0
 
             self.name = parameters['area']
             self.background = parameters['background']
@@ -96,14 +113,195 @@ class AreaManager:
                         .format(self.name, char_name))
                 raise AreaError(info)
 
+        @property
+        def reachable_areas(self):
+            return self._reachable_areas
+
+        @reachable_areas.setter
+        def reachable_areas(self, value):
+            # Any reassignment invalidates the cached sorted list. Code that edits the set in
+            # place must assign it back afterwards, as the reachability commands do.
+            self._reachable_areas = value
+            self._sorted_reachable_areas = None
+
+        @property
+        def scream_range(self):
+            return self._scream_range
+
+        @scream_range.setter
+        def scream_range(self, value):
+            # Same as with reachable_areas, in-place edits must assign the set back afterwards
+            self._scream_range = value
+            self._scream_areas = None
+
+        def get_scream_areas(self):
+            """
+            Returns the areas in the scream range of this area, resolved from their names once
+            and cached until the scream range changes. A new area list creates new areas, so
+            nothing resolved against the old one is kept.
+            """
+            if self._scream_areas is None:
+                areas_by_name = self.server.area_manager.areas_by_name
+                self._scream_areas = [areas_by_name[name] for name in self.scream_range
+                                      if name in areas_by_name]
+            return self._scream_areas
+
+        def get_sorted_reachable_areas(self):
+            """ Returns the names of the reachable areas sorted by area ID.
+
+            The list is computed once and reused until reachable_areas is reassigned, so it
+            must not be modified by callers.
+
+            :raises AreaError: if some reachable area is not an area name (e.g. '<ALL>')
+            """
+            if self._sorted_reachable_areas is None:
+                area_manager = self.server.area_manager
+                self._sorted_reachable_areas = sorted(self.reachable_areas,
+                                                      key=lambda area_name: area_manager.get_area_by_name(area_name).id)
+            return self._sorted_reachable_areas
+
         def new_client(self, client):
             self.clients.add(client)
+            self.add_char_occupant(client.char_id)
+            self.count_client(client)
+            self.invalidate_roster()
 
         def remove_client(self, client):
             self.clients.remove(client)
+            self.remove_char_occupant(client.char_id)
+            self.count_client(client, -1)
+            self.invalidate_roster()
             if len(self.clients) == 0:
                 self.unlock()
 
+        def count_client(self, client, sign=1):
+            """
+            Adds the client to the population counters of the area, or takes it out of them if
+            sign is -1. Clients are taken out with their old state and added back with their new
+            one whenever they change, see Client.update_state.
+            """
+            is_player = client.char_id is not None
+            self.player_count += sign * is_player
+            self.visible_player_count += sign * (is_player and client.is_visible)
+            self.visible_count += sign * client.is_visible
+            self.spectator_count += sign * (client.char_id == -1)
+            self.bleeding_count += sign * client.is_bleeding
+            self.cm_count += sign * client.is_cm
+            self.staff_count += sign * client.is_staff()
+            # Every connected client is in exactly one area, so this also keeps the server total
+            self.server.player_count += sign * is_player
+
+        def add_char_occupant(self, char_id):
+            if char_id is not None:
+                self.char_occupancy[char_id] += 1
+                if char_id != -1:
+                    self.invalidate_join_bundle()
+
+        def remove_char_occupant(self, char_id):
+            if char_id is not None:
+                self.char_occupancy[char_id] -= 1
+                if self.char_occupancy[char_id] <= 0:
+                    del self.char_occupancy[char_id]
+                if char_id != -1:
+                    self.invalidate_join_bundle()
+
+        def invalidate_join_bundle(self):
+            """
+            Marks the cached join bundles as stale. Must be called whenever something they
+            contain changes: taken or restricted characters, sneaking players, penalties or background.
+            """
+            self.join_bundle_version += 1
+
+        def invalidate_roster(self):
+            """
+            Marks the cached /getarea listings as stale. Must be called whenever a client enters
+            or leaves the area or changes how it is listed: character, showname, sneaking or mod status.
+            """
+            self.roster_version += 1
+
+        def get_cached_roster(self, key, build):
+            """
+            Returns the listing cached under the given key, calling build() to make it if the
+            area or the server configuration (and with it character names) changed since.
+            """
+            version = (self.roster_version, self.server.join_bundle_version)
+            try:
+                roster_version, roster = self.rosters[key]
+                if roster_version == version:
+                    return roster
+            except KeyError:
+                pass
+
+            roster = build()
+            self.rosters[key] = (version, roster)
+            return roster
+
+        def get_roster(self, show_ipid, include_shownames):
+            """
+            Returns the clients past the server selection screen sorted by character name, each
+            with its /getarea line.
+
+            :param show_ipid: whether the lines include IPIDs
+            :param include_shownames: whether the lines include non-empty custom shownames
+            :return: list of (client, line) tuples
+            """
+            def build():
+                roster = []
+                clients = [c for c in self.clients if c.char_id is not None]
+                for c in sorted(clients, key=lambda x: x.get_char_name()):
+                    line = '\r\n[{}] {}'.format(c.id, c.get_char_name())
+                    if include_shownames and c.showname != '':
+                        line += ' ({})'.format(c.showname)
+                    if not c.is_visible:
+                        line += ' (S)'
+                    if show_ipid:
+                        line += ' ({})'.format(c.ipid)
+                    roster.append((c, line))
+                return roster
+            return self.get_cached_roster(('roster', show_ipid, include_shownames), build)
+
+        def get_join_bundle(self, is_staff):
+            """
+            Returns the frames sent to a client that (re)joins this area, before and after its
+            evidence list, which is the only part that depends on the client itself.
+
+            The frames are encoded once and reused until the area or the server configuration
+            changes, so a wave of reconnecting clients costs one rebuild per area.
+
+            :param is_staff: whether the bundle is for a staff member, who see restricted and
+            sneaking players' characters as taken
+            :return: tuple (frames before LE, frames after LE)
+            """
+            version = (self.join_bundle_version, self.server.join_bundle_version)
+            try:
+                bundle_version, bundle = self.join_bundles[is_staff]
+                if bundle_version == version:
+                    return bundle
+            except KeyError:
+                pass
+
+            unusable_char_ids = self.get_chars_unusable(allow_restricted=is_staff)
+            # Sneaked players' characters show up as free so that they don't give away their presence.
+            # Their characters will not be able to be reused, but at least that's one less clue about their presence.
+            if not is_staff:
+                unusable_char_ids -= set([c.char_id for c in self.clients if not c.is_visible])
+            char_list = [0] * len(self.server.char_list)
+            for char_id in unusable_char_ids:
+                # Clients may still hold IDs past the end of a character list reloaded since
+                if 0 <= char_id < len(char_list):
+                    char_list[char_id] = -1
+
+            head = b''.join([packets.build_command('CharsCheck', *char_list),
+                             packets.build_command('HP', 1, self.hp_def),
+                             packets.build_command('HP', 2, self.hp_pro),
+                             packets.build_command('BN', self.background)])
+            tail = b''.join([packets.build_command('MM', 1),
+                             self.server.oppass_frame,
+                             packets.build_command('DONE')])
+            bundle = (head, tail)
+            self.join_bundles[is_staff] = (version, bundle)
+            return bundle
+
         def unlock(self):
             self.is_locked = False
             if not self.is_gmlocked and not self.is_modlocked:
@@ -123,21 +321,35 @@ class AreaManager:
 
         def get_chars_unusable(self, allow_restricted=False):
             if allow_restricted:
-                return set([x.char_id for x in self.clients if x.char_id is not None])
-            return set([x.char_id for x in self.clients if x.char_id is not None]).union(set([self.server.char_list.index(char_name) for char_name in self.restricted_chars]))
+                return set(self.char_occupancy)
+            return set(self.char_occupancy).union(set([self.server.char_ids[char_name] for char_name in self.restricted_chars]))
 
         def is_char_available(self, char_id, allow_restricted=False):
-            return (char_id == -1) or (char_id not in self.get_chars_unusable(allow_restricted=allow_restricted))
+            if char_id is None or char_id == -1:
+                return True
+            if char_id in self.char_occupancy:
+                return False
+            return allow_restricted or self.server.char_list[char_id] not in self.restricted_chars
 
         def get_rand_avail_char_id(self, allow_restricted=False):
-            avail_set = set(range(len(self.server.char_list))) - self.get_chars_unusable(allow_restricted=allow_restricted)
+            # Usually most characters are free, so a few random draws find one without
+            # building the set of every available character.
+            char_count = len(self.server.char_list)
+            if char_count > 0:
+                for _ in range(8):
+                    char_id = random.randrange(char_count)
+                    if self.is_char_available(char_id, allow_restricted=allow_restricted):
+                        return char_id
+
+            avail_set = set(range(char_count)) - self.get_chars_unusable(allow_restricted=allow_restricted)
             if len(avail_set) == 0:
                 raise AreaError('No available characters.')
             return random.choice(tuple(avail_set))
 
         def send_command(self, cmd, *args):
+            frame = packets.build_command(cmd, *args)
             for c in self.clients:
-                c.send_command(cmd, *args)
+                c.send_frame(frame)
 
         def send_host_message(self, msg):
             self.send_command('CT', self.server.config['hostname'], msg)
@@ -176,16 +388,19 @@ class AreaManager:
                 self.hp_def = val
             elif side == 2:
                 self.hp_pro = val
+            self.invalidate_join_bundle()
             self.send_command('HP', side, val)
 
         def change_background(self, bg):
             if bg.lower() not in (name.lower() for name in self.server.backgrounds):
                 raise AreaError('Invalid background name.')
             self.background = bg
+            self.invalidate_join_bundle()
             self.send_command('BN', self.background)
 
         def change_background_mod(self, bg):
             self.background = bg
+            self.invalidate_join_bundle()
             self.send_command('BN', self.background)
 
         def change_lights(self, new_lights, initiator=None):
@@ -211,20 +426,18 @@ class AreaManager:
 
             if initiator: # If a player initiated the change light sequence, send targeted messages
                 initiator.send_host_message('You turned the lights {}.'.format(status[new_lights]))
-                self.server.send_all_cmd_pred('CT', '{}'.format(self.server.config['hostname']),
-                                              'The lights were turned {}.'.format(status[new_lights]),
-                                              pred=lambda c: not c.is_staff() and c.area == self
-                                              and c != initiator)
-                self.server.send_all_cmd_pred('CT', '{}'.format(self.server.config['hostname']),
-                                              '{} turned the lights {}.'
-                                              .format(initiator.get_char_name(), status[new_lights]),
-                                              pred=lambda c: c.is_staff() and c.area == self
-                                              and c != initiator)
+                self.server.send_all_cmd_set(self.clients, 'CT', '{}'.format(self.server.config['hostname']),
+                                             'The lights were turned {}.'.format(status[new_lights]),
+                                             pred=lambda c: not c.is_staff() and c != initiator)
+                self.server.send_all_cmd_set(self.clients, 'CT', '{}'.format(self.server.config['hostname']),
+                                             '{} turned the lights {}.'
+                                             .format(initiator.get_char_name(), status[new_lights]),
+                                             pred=lambda c: c.is_staff() and c != initiator)
             else: # Otherwise, send generic message
                 self.send_host_message('The lights were turned {}.'.format(status[new_lights]))
 
             # Reveal people bleeding and not sneaking if lights were turned on
-            if self.lights:
+            if self.lights and self.bleeding_count > 0:
                 for c in self.clients:
                     bleeding_visible = [x for x in self.clients if x.is_visible and x.is_bleeding
                                         and x != c]
@@ -275,22 +488,23 @@ class AreaManager:
         self.server = server
         self.areas = []
         self.area_names = set()
+        self.areas_by_id = dict()
+        self.areas_by_name = dict()
         self.load_areas()
 
     def get_area_by_name(self, name):
-        for area in self.areas:
-            if area.name == name:
-                return area
-        raise AreaError('Area not found.')
+        try:
+            return self.areas_by_name[name]
+        except KeyError:
+            raise AreaError('Area not found.')
 
     def get_area_by_id(self, num):
-        for area in self.areas:
-            if area.id == num:
-                return area
-        raise AreaError('Area not found.')
+        try:
+            return self.areas_by_id[num]
+        except KeyError:
+            raise AreaError('Area not found.')
 
     def load_areas(self, area_list_file='config/areas.yaml'):
-        self.area_names = set()
         current_area_id = 0
         temp_areas = list()
         temp_area_names = set()
@@ -381,6 +595,9 @@ class AreaManager:
         # Helps avoiding junk area lists if there was an error
         self.areas = temp_areas
         self.area_names = temp_area_names
+        self.areas_by_id = {area.id: area for area in temp_areas}
+        self.areas_by_name = {area.name: area for area in temp_areas}
+        self.server.invalidate_music_list_frames()
 
         # If the default area ID is now past the number of available areas, reset it back to zero
         if self.server.default_area >= len(self.areas):
@@ -388,6 +605,8 @@ class AreaManager:
 
         # Move existing clients to new corresponding area (or to default area if their previous area no longer exists)
         for client in self.server.client_manager.clients:
+            if client.multi_ic is not None:
+                client.multi_ic = client.multi_ic # Resolve the range again against the new areas
             try:
                 new_area = self.get_area_by_name(client.area.name)
                 client.change_area(new_area, override_all=True)
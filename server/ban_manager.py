@@ -15,7 +15,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
 import ipaddress
 
 from server.exceptions import ServerError
@@ -23,20 +22,12 @@ from server.exceptions import ServerError
 
 class BanManager:
     def __init__(self, server):
-        self.bans = []
-        self.load_banlist()
         self.server = server
+        self.bans = set()
+        self.load_banlist()
 
     def load_banlist(self):
-        try:
-            with open('storage/banlist.json', 'r') as banlist_file:
-                self.bans = json.load(banlist_file)
-        except FileNotFoundError:
-            return
-
-    def write_banlist(self):
-        with open('storage/banlist.json', 'w') as banlist_file:
-            json.dump(self.bans, banlist_file)
+        self.bans = self.server.storage.get_bans()
 
     def add_ban(self, ip):
         try:
@@ -48,10 +39,10 @@ class BanManager:
         except ValueError:
             raise ServerError('Argument must be an IP address or 10-digit number.')
         if ip not in self.bans:
-            self.bans.append(ip)
+            self.bans.add(ip)
         else:
             raise ServerError('User is already banned.')
-        self.write_banlist()
+        self.server.storage.add_ban(ip)
 
     def remove_ban(self, ip):
         try:
@@ -66,7 +57,7 @@ class BanManager:
             self.bans.remove(ip)
         else:
             raise ServerError('This IPID is not banned.')
-        self.write_banlist()
+        self.server.storage.remove_ban(ip)
 
     def is_banned(self, ipid):
         return ipid in self.bans
@@ -0,0 +1,162 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import sqlite3
+import time
+
+from datetime import datetime, timezone
+
+
+class ChatArchive:
+    """
+    Searchable archive of IC, OOC, music and judge events, with one SQLite file per (UTC) day.
+
+    Events are indexed by time, IPID and area, and their text through a full-text index, so
+    searches only read the matching rows of the days in the requested range. Writing is done
+    by the log listener thread (see logger.ArchiveHandler); searches open their own read-only
+    connections and can run from any thread or from another process.
+    """
+    FILE_PATTERN = re.compile(r'^chat-(\d{4}-\d{2}-\d{2})\.db$')
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (time REAL NOT NULL, kind TEXT NOT NULL, area INTEGER,
+                                           client INTEGER, ipid INTEGER, char_name TEXT,
+                                           showname TEXT, message TEXT);
+        CREATE INDEX IF NOT EXISTS events_by_time ON events (time);
+        CREATE INDEX IF NOT EXISTS events_by_ipid ON events (ipid, time);
+        CREATE INDEX IF NOT EXISTS events_by_area ON events (area, time);
+        CREATE VIRTUAL TABLE IF NOT EXISTS events_text USING fts5(message, content='events',
+                                                                  content_rowid='rowid');
+        CREATE TRIGGER IF NOT EXISTS events_text_insert AFTER INSERT ON events BEGIN
+            INSERT INTO events_text (rowid, message) VALUES (new.rowid, new.message);
+        END;
+        """
+
+    def __init__(self, directory='storage/archive'):
+        self.directory = directory
+        self.write_day = None
+        self.write_connection = None
+
+    def get_path(self, day):
+        return os.path.join(self.directory, 'chat-{}.db'.format(day))
+
+    def write(self, event):
+        """ Stores an event, a tuple (time, kind, area, client, ipid, char_name, showname, message). """
+        day = time.strftime('%Y-%m-%d', time.gmtime(event[0]))
+        if day != self.write_day:
+            self.close()
+            os.makedirs(self.directory, exist_ok=True)
+            # Only ever used by one thread at a time, but closed by whichever stops the logs
+            self.write_connection = sqlite3.connect(self.get_path(day), check_same_thread=False)
+            self.write_connection.execute('PRAGMA journal_mode=WAL')
+            self.write_connection.execute('PRAGMA synchronous=NORMAL')
+            self.write_connection.executescript(self.SCHEMA)
+            self.write_day = day
+        self.write_connection.execute('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)', event)
+        self.write_connection.commit()
+
+    def close(self):
+        if self.write_connection is not None:
+            self.write_connection.close()
+            self.write_connection = None
+            self.write_day = None
+
+    def get_days(self, since=None, until=None):
+        """ Returns the days with an archive file between the given timestamps, newest first. """
+        try:
+            file_names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        first = time.strftime('%Y-%m-%d', time.gmtime(since)) if since is not None else ''
+        last = time.strftime('%Y-%m-%d', time.gmtime(until)) if until is not None else '9999'
+        days = []
+        for file_name in file_names:
+            match = self.FILE_PATTERN.match(file_name)
+            if match and first <= match.group(1) <= last:
+                days.append(match.group(1))
+        return sorted(days, reverse=True)
+
+    def search(self, ipid=None, area=None, since=None, until=None, kind=None, text=None, limit=50):
+        """
+        Returns the newest events matching every given filter, newest first.
+
+        :param ipid: IPID of the sender
+        :param area: area ID
+        :param since: earliest timestamp
+        :param until: latest timestamp
+        :param kind: 'IC', 'OOC', 'music' or 'judge'
+        :param text: exact phrase that must appear in the message
+        :param limit: maximum number of events returned
+        :return: list of event tuples, see write
+        """
+        conditions = []
+        parameters = []
+        for column, operator, value in (('ipid', '=', ipid), ('area', '=', area), ('time', '>=', since),
+                                        ('time', '<=', until), ('kind', '=', kind)):
+            if value is not None:
+                conditions.append('{} {} ?'.format(column, operator))
+                parameters.append(value)
+        if text:
+            conditions.append('rowid IN (SELECT rowid FROM events_text WHERE events_text MATCH ?)')
+            parameters.append('"{}"'.format(text.replace('"', '""')))
+        query = 'SELECT time, kind, area, client, ipid, char_name, showname, message FROM events'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY time DESC LIMIT ?'
+
+        events = []
+        for day in self.get_days(since, until):
+            connection = sqlite3.connect('file:{}?mode=ro'.format(self.get_path(day)), uri=True)
+            try:
+                events += connection.execute(query, parameters + [limit - len(events)]).fetchall()
+            except sqlite3.DatabaseError: # File being created right now or not an archive
+                pass
+            finally:
+                connection.close()
+            if len(events) >= limit:
+                break
+        return events
+
+
+def parse_time(text, now=None):
+    """
+    Converts a time given to an archive search into a timestamp.
+
+    :param text: relative time such as 30m, 12h or 7d (that long ago), or a UTC date or
+    date and time such as 2019-06-22 or 2019-06-22T18:30
+    :param now: timestamp relative times are counted back from, defaults to the current time
+    :raises ValueError: if the text is neither
+    """
+    match = re.match(r'^(\d+)([mhd])$', text)
+    if match:
+        unit = {'m': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+        return (time.time() if now is None else now) - int(match.group(1)) * unit
+    for time_format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(text, time_format).replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            pass
+    raise ValueError('Invalid time {}.'.format(text))
+
+
+def format_event(event):
+    """ Returns a one line description of an archived event. """
+    timestamp, kind, area, client, ipid, char_name, showname, message = event
+    sender = char_name if not showname else '{} ({})'.format(char_name, showname)
+    return '[{}][{}][{}][{}][{}] {}: {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp)),
+                                                kind, area, ipid, client, sender, message)
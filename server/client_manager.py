@@ -16,13 +16,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import heapq
 import time
 import re
 import random
 
-from server import fantacrypt
+from collections import Counter
 from server import logger
-from server.exceptions import ClientError, AreaError
+from server import packets
+from server.exceptions import ClientError, AreaError, ServerError
 from server.constants import TargetType
 
 class ClientManager:
@@ -32,31 +34,32 @@ class ClientManager:
             self.hdid = ''
             self.pm_mute = False
             self.id = user_id
-            self.char_id = None
+            self._char_id = None
+            self._name = ''
             self.area = server.area_manager.default_area()
             self.server = server
-            self.name = ''
             self.fake_name = ''
-            self.is_mod = False
-            self.is_gm = False
+            self._is_mod = False
+            self._is_gm = False
             self.is_dj = True
             self.pos = ''
-            self.is_cm = False
+            self._is_cm = False
             self.evi_list = []
             self.disemvowel = False
             self.remove_h = False
             self.disemconsonant = False
             self.gimp = False
-            self.muted_global = False
-            self.muted_adverts = False
+            self._muted_global = False
+            self._muted_adverts = False
             self.is_muted = False
             self.is_ooc_muted = False
             self.pm_mute = False
             self.mod_call_time = 0
             self.in_rp = False
             self.ipid = ipid
-            self.is_visible = True
-            self.multi_ic = None
+            self._is_visible = True
+            self._multi_ic = None
+            self.multi_ic_areas = None
             self.showname = ''
             self.following = None
             self.followedby = None
@@ -67,7 +70,24 @@ class ClientManager:
             self.handicap_backup = None # Use if custom handicap is overwritten with a server one
             self.is_movement_handicapped = False
             self.show_shownames = True
-            self.is_bleeding = False
+            self._is_bleeding = False
+
+            # Frames sent during the current event loop iteration, written together by flush()
+            self.pending_frames = []
+            self.pending_bytes = 0
+            self.flush_handle = None
+            # Backpressure state, see pause_writing
+            self.write_paused = False
+            self.stall_timer = None
+            self.dropped_frames = 0
+            self.peak_queue_depth = 0
+
+            # Packet flood-guard state, see FloodGuard
+            self.flood_buckets = dict()
+            self.flood_strikes = 0
+            self.flood_mutes = 0
+            self.flood_mute_end = 0
+            self.flood_dropped = 0
 
             #music flood-guard stuff
             self.mus_counter = 0
@@ -78,53 +98,246 @@ class ClientManager:
             self.mus_change_time = [x * self.mflood_interval for x in range(self.mflood_times)]
 
         def send_raw_message(self, msg):
-            self.transport.write(msg.encode('utf-8'))
-
-        def send_command(self, command, *args):
-            if args:
-                if command == 'MS':
-                    for evi_num in range(len(self.evi_list)):
-                        if self.evi_list[evi_num] == args[11]:
-                            lst = list(args)
-                            lst[11] = evi_num
-                            args = tuple(lst)
-                            break
-                self.send_raw_message('{}#{}#%'.format(command, '#'.join([str(x) for x in args])))
+            self.send_frame(msg.encode('utf-8'))
+
+        def send_frame(self, frame, flush=False):
+            """
+            Queues a frame already built with packets.build_command.
+
+            Frames queued during one iteration of the event loop are written to the transport
+            together once the iteration ends, so a burst of commands costs one write.
+
+            While the transport is paused, OOC and server messages are dropped and everything
+            else waits until the client catches up, up to the configured max_queued bytes.
+
+            :param frame: the encoded frame
+            :param flush: write the frame (and anything queued before it) right away
+            """
+            if self.write_paused:
+                if frame.startswith(packets.NON_ESSENTIAL_FRAMES):
+                    self.dropped_frames += 1
+                    return
+                self.pending_frames.append(frame)
+                self.pending_bytes += len(frame)
+                self.peak_queue_depth = max(self.peak_queue_depth, self.get_queue_depth())
+                if self.pending_bytes > self.server.config['output_buffer']['max_queued']:
+                    self.drop_connection('queued too much unsent data')
+                return
+            self.pending_frames.append(frame)
+            self.pending_bytes += len(frame)
+            if flush:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = self.server.loop.call_soon(self.flush)
+
+        def flush(self):
+            """ Writes every queued frame to the transport in a single call. """
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+                self.flush_handle = None
+            if not self.pending_frames or self.write_paused:
+                return
+            if len(self.pending_frames) == 1:
+                self.transport.write(self.pending_frames[0])
+            else:
+                self.transport.write(b''.join(self.pending_frames))
+            self.pending_frames.clear()
+            self.pending_bytes = 0
+            self.peak_queue_depth = max(self.peak_queue_depth, self.transport.get_write_buffer_size())
+
+        def get_queue_depth(self):
+            """ Returns how many bytes sent to this client have not reached the network yet. """
+            return self.pending_bytes + self.transport.get_write_buffer_size()
+
+        def pause_writing(self):
+            """
+            Called once the transport buffer passes its high watermark. Frames are held back
+            until it drains, and the client is disconnected if that takes longer than the
+            configured grace period.
+            """
+            self.write_paused = True
+            self.stall_timer = self.server.timer_manager.schedule(
+                self.server.config['output_buffer']['grace_period'],
+                lambda: self.drop_connection('stopped reading for too long'))
+
+        def resume_writing(self):
+            """ Called once the transport buffer drains below its low watermark. """
+            self.write_paused = False
+            if self.stall_timer is not None:
+                self.stall_timer.cancel()
+                self.stall_timer = None
+            self.flush()
+
+        def drop_connection(self, reason):
+            """ Aborts the connection of a client that cannot keep up, discarding unsent data. """
+            if self.transport.is_closing():
+                return
+            logger.log_server('Disconnected slow client: {}. {} frames dropped, {} bytes queued.'
+                              .format(reason, self.dropped_frames, self.get_queue_depth()), self)
+            self.pending_frames.clear()
+            self.pending_bytes = 0
+            self.transport.abort()
+
+        @property
+        def char_id(self):
+            return self._char_id
+
+        @char_id.setter
+        def char_id(self, char_id):
+            # Keep the character occupancy of the client's area in sync
+            if self in self.area.clients:
+                self.area.remove_char_occupant(self._char_id)
+                self.area.add_char_occupant(char_id)
+            self.update_state('_char_id', char_id)
+            self.server.client_manager.directory.index(self, TargetType.CHAR_NAME)
+
+        @property
+        def is_visible(self):
+            return self._is_visible
+
+        @is_visible.setter
+        def is_visible(self, value):
+            self.update_state('_is_visible', value)
+
+        @property
+        def is_bleeding(self):
+            return self._is_bleeding
+
+        @is_bleeding.setter
+        def is_bleeding(self, value):
+            self.update_state('_is_bleeding', value)
+
+        @property
+        def is_mod(self):
+            return self._is_mod
+
+        @is_mod.setter
+        def is_mod(self, value):
+            self.update_state('_is_mod', value)
+            self.server.client_manager.update_subscriptions(self)
+
+        @property
+        def is_cm(self):
+            return self._is_cm
+
+        @is_cm.setter
+        def is_cm(self, value):
+            self.update_state('_is_cm', value)
+            self.server.client_manager.update_subscriptions(self)
+
+        @property
+        def is_gm(self):
+            return self._is_gm
+
+        @is_gm.setter
+        def is_gm(self, value):
+            self.update_state('_is_gm', value)
+            self.server.client_manager.update_subscriptions(self)
+
+        @property
+        def multi_ic(self):
+            return self._multi_ic
+
+        @multi_ic.setter
+        def multi_ic(self, value):
+            # Resolve the [first area, last area] range once instead of on every IC message.
+            # Areas are listed by ID, so slicing also leaves out IDs past the end of the list.
+            self._multi_ic = value
+            if value is None:
+                self.multi_ic_areas = None
             else:
-                self.send_raw_message('{}#%'.format(command))
+                self.multi_ic_areas = self.server.area_manager.areas[value[0].id:value[1].id + 1]
+
+        @property
+        def muted_global(self):
+            return self._muted_global
+
+        @muted_global.setter
+        def muted_global(self, value):
+            self._muted_global = value
+            self.server.client_manager.update_subscriptions(self)
+
+        @property
+        def muted_adverts(self):
+            return self._muted_adverts
+
+        @muted_adverts.setter
+        def muted_adverts(self, value):
+            self._muted_adverts = value
+            self.server.client_manager.update_subscriptions(self)
+
+        def update_state(self, attribute, value):
+            """
+            Changes an attribute the population counters of areas depend on (character, visibility,
+            bleeding or staff roles), taking the client out of its area's counters with the old
+            value and adding it back with the new one.
+            """
+            area = self.area
+            if self not in area.clients: # Not counted anywhere yet (or anymore)
+                setattr(self, attribute, value)
+                return
+            area.count_client(self, -1)
+            setattr(self, attribute, value)
+            area.count_client(self)
+            area.invalidate_roster()
+
+        @property
+        def name(self):
+            return self._name
+
+        @name.setter
+        def name(self, name):
+            self._name = name
+            self.server.client_manager.directory.index(self, TargetType.OOC_NAME)
+
+        def send_command(self, command, *args, flush=False):
+            if args and command == 'MS':
+                lst = list(args)
+                lst[11] = self.get_evidence_index(args[11])
+                args = tuple(lst)
+            self.send_frame(packets.build_command(command, *args), flush=flush)
+
+        def get_evidence_index(self, evidence_id):
+            """
+            Returns the position of the given evidence in this client's evidence list,
+            or the evidence ID itself if the client cannot see that evidence.
+            """
+            try:
+                return self.evi_list.index(evidence_id)
+            except ValueError:
+                return evidence_id
 
         def send_host_message(self, msg):
             self.send_command('CT', self.server.config['hostname'], msg)
 
         def send_host_others(self, msg, is_staff=None, in_area=None, pred=None):
-            if is_staff is True:
-                cond1 = lambda c: c.is_staff()
-            elif is_staff is False:
-                cond1 = lambda c: not c.is_staff()
-            elif is_staff is None:
-                cond1 = lambda c: True
-            else:
+            if is_staff not in (True, False, None):
                 raise KeyError('Invalid argument for send_host_others is_staff: {}'.format(is_staff))
 
             if in_area is True:
-                cond2 = lambda c: c.area == self.area
-            elif type(in_area) is type(self.area): # Lazy way of checking if in_area is an area obj
-                cond2 = lambda c: c.area == in_area
-            elif in_area is None:
-                cond2 = lambda c: True
-            else:
+                in_area = self.area
+            elif in_area is not None and type(in_area) is not type(self.area): # Lazy way of checking if in_area is an area obj
                 raise KeyError('Invalid argument for send_host_others in_area: {}'.format(in_area))
 
-            if pred is None:
-                pred = lambda c: True
+            # Only walk the clients that can be recipients
+            if in_area is not None:
+                recipients = in_area.clients
+            elif is_staff is True:
+                recipients = self.server.client_manager.staff
+            else:
+                recipients = self.server.client_manager.clients
 
-            cond = lambda c: c != self and cond1(c) and cond2(c) and pred(c)
+            def cond(c):
+                if c == self:
+                    return False
+                if is_staff is not None and c.is_staff() != is_staff:
+                    return False
+                return pred is None or pred(c)
 
-            self.server.send_all_cmd_pred('CT', self.server.config['hostname'], msg, pred=cond)
+            self.server.send_all_cmd_set(recipients, 'CT', self.server.config['hostname'], msg, pred=cond)
 
         def send_motd(self):
-            self.send_host_message('=== MOTD ===\r\n{}\r\n============='
-                                   .format(self.server.config['motd']))
+            self.send_frame(self.server.motd_frame)
 
         def is_valid_name(self, name):
             name_ws = name.replace(' ', '')
@@ -137,6 +350,7 @@ class ClientManager:
             return True
 
         def disconnect(self):
+            self.flush() # Make sure anything sent right before disconnecting still goes out
             self.transport.close()
 
         def is_staff(self):
@@ -208,14 +422,10 @@ class ClientManager:
                 new_music_list = self.server.load_music(music_list_file=new_music_file,
                                                         server_music_list=False)
                 self.music_list = new_music_list
-                self.server.build_music_list_ao2(from_area=self.area, c=self,
-                                                 music_list=new_music_list)
-            else:
-                self.server.build_music_list_ao2(from_area=self.area, c=self)
             # KEEP THE ASTERISK, unless you want a very weird single area comprised
             # of all areas back to back forming a black hole area of doom and despair
             # that crashes all clients that dare attempt join this area.
-            self.send_command('FM', *self.server.music_list_ao2)
+            self.send_frame(self.server.get_music_list_frame('FM', from_area=self.area, c=self))
 
         def change_area(self, area, override_all=False, override_passages=False,
                         override_effects=False, ignore_bleeding=False, ignore_followers=False):
@@ -260,7 +470,7 @@ class ClientManager:
                         info += '\r\n*No areas available.'
                     else:
                         try:
-                            sorted_areas = sorted(self.area.reachable_areas, key=lambda area_name: self.server.area_manager.get_area_by_name(area_name).id)
+                            sorted_areas = self.area.get_sorted_reachable_areas()
                             for reachable_area in sorted_areas:
                                 if reachable_area != self.area.name:
                                     info += '\r\n*({}) {}'.format(self.server.area_manager.get_area_by_name(reachable_area).id, reachable_area)
@@ -302,14 +512,14 @@ class ClientManager:
 
                 # If autopassing, send OOC messages, provided the lights are on
                 if self.autopass and not self.char_id < 0:
-                    self.server.send_all_cmd_pred('CT', '{}'.format(self.server.config['hostname']),
-                                                  '{} has left to the {}.'.format(old_char, area.name),
-                                                  pred=lambda c: (c != self and c.area == old_area
-                                                  and (c.is_staff() or (old_area.lights and self.is_visible))))
-                    self.server.send_all_cmd_pred('CT', '{}'.format(self.server.config['hostname']),
-                                                  '{} has entered from the {}.'.format(self.get_char_name(), old_area.name),
-                                                  pred=lambda c: (c != self and c.area == area
-                                                  and (c.is_staff() or (area.lights and self.is_visible))))
+                    self.server.send_all_cmd_set(old_area.clients, 'CT', '{}'.format(self.server.config['hostname']),
+                                                 '{} has left to the {}.'.format(old_char, area.name),
+                                                 pred=lambda c: (c != self
+                                                 and (c.is_staff() or (old_area.lights and self.is_visible))))
+                    self.server.send_all_cmd_set(area.clients, 'CT', '{}'.format(self.server.config['hostname']),
+                                                 '{} has entered from the {}.'.format(self.get_char_name(), old_area.name),
+                                                 pred=lambda c: (c != self
+                                                 and (c.is_staff() or (area.lights and self.is_visible))))
 
                 # If former or new area's lights are turned off, send special messages to non-staff
                 # announcing your presence
@@ -333,7 +543,7 @@ class ClientManager:
                     self.send_host_message('You are bleeding.')
 
                     # Send notification to people in new area
-                    area_had_bleeding = (len([c for c in area.clients if c.is_bleeding]) > 0)
+                    area_had_bleeding = (area.bleeding_count > 0)
                     if self.is_visible and area.lights:
                         normal_mes = 'You see {} arrive and bleeding.'.format(self.get_char_name())
                         staff_mes = normal_mes
@@ -363,7 +573,7 @@ class ClientManager:
                 # off, notify everyone in the new area to the less intense sounds and smells of
                 # blood. Do nothing if lights on and not sneaking.
                 if not ignore_bleeding and self.is_bleeding:
-                    area_sole_bleeding = (len([c for c in old_area.clients if c.is_bleeding]) == 1)
+                    area_sole_bleeding = (old_area.bleeding_count == 1)
                     if self.is_visible and old_area.lights:
                         normal_mes = ''
                         staff_mes = ''
@@ -392,8 +602,11 @@ class ClientManager:
                 # If someone else is bleeding in the new area, notify the person moving
                 # Special consideration is given if that someone else is sneaking or the area's
                 # lights are turned off, or the client is a staff member
-                bleeding_visible = [c for c in area.clients if c.is_visible and c.is_bleeding]
-                bleeding_sneaking = [c for c in area.clients if not c.is_visible and c.is_bleeding]
+                bleeding_visible = []
+                bleeding_sneaking = []
+                if area.bleeding_count > 0:
+                    bleeding_visible = [c for c in area.clients if c.is_visible and c.is_bleeding]
+                    bleeding_sneaking = [c for c in area.clients if not c.is_visible and c.is_bleeding]
                 info = ''
                 sneak_info = ''
 
@@ -502,12 +715,14 @@ class ClientManager:
                     self.showname_history.append("{} | {} set to {}".format(time.asctime(time.localtime(time.time())), status[forced], showname))
                 else:
                     self.showname_history.append("{} | {} cleared".format(time.asctime(time.localtime(time.time())), status[forced]))
+                self.area.invalidate_roster()
             self.showname = showname
 
         def change_visibility(self, new_status):
             if new_status: # Changed to visible (e.g. through /reveal)
                 self.send_host_message("You are no longer sneaking.")
                 self.is_visible = True
+                self.area.invalidate_join_bundle()
 
                 # Player should also no longer be under the effect of the server's sneaked handicap.
                 # Thus, we check if there existed a previous movement handicap that had a shorter delay
@@ -539,6 +754,7 @@ class ClientManager:
             else: # Changed to invisible (e.g. through /sneak)
                 self.send_host_message("You are now sneaking.")
                 self.is_visible = False
+                self.area.invalidate_join_bundle()
 
                 # Check to see if should impose the server's sneak handicap on the player
                 # This should only happen if two conditions are satisfied:
@@ -601,16 +817,16 @@ class ClientManager:
             lock = {True: '[LOCKED]', False: ''}
             for i, area in enumerate(self.server.area_manager.areas):
                 owner = 'FREE'
-                if area.owned:
+                if area.owned and area.cm_count > 0:
                     for client in [x for x in area.clients if x.is_cm]:
                         owner = 'MASTER: {}'.format(client.get_char_name())
                         break
                 locked = area.is_gmlocked or area.is_modlocked or area.is_locked
 
                 if self.is_staff():
-                    num_clients = len([c for c in area.clients if c.char_id is not None])
+                    num_clients = area.player_count
                 else:
-                    num_clients = len([c for c in area.clients if c.is_visible and c.char_id is not None])
+                    num_clients = area.visible_player_count
 
                 msg += '\r\nArea {}: {} (users: {}) {}'.format(i, area.name, num_clients, lock[locked])
                 if self.area == area:
@@ -626,15 +842,15 @@ class ClientManager:
             self.send_host_message(msg)
 
         def get_area_info(self, area_id, mods, include_shownames=False):
-            info = ''
             try:
                 area = self.server.area_manager.get_area_by_id(area_id)
             except AreaError:
                 raise
 
-            info += '= Area {}: {} =='.format(area.id, area.name)
-            sorted_clients = []
-            for c in area.clients:
+            is_staff = self.is_staff()
+
+            def build():
+                info = '= Area {}: {} =='.format(area.id, area.name)
                 # Conditions to print out a client in /getarea(s)
                 # * Client is not in the server selection screen and,
                 # * Any of the four
@@ -642,20 +858,15 @@ class ClientManager:
                 # 2. You are a staff member.
                 # 3. Client is visible.
                 # 4. Client is a mod when requiring only mods be printed.
-                if c.char_id is not None:
-                    if c == self or self.is_staff() or c.is_visible or (mods and c.is_mod):
-                        sorted_clients.append(c)
-            sorted_clients = sorted(sorted_clients, key=lambda x: x.get_char_name())
-
-            for c in sorted_clients:
-                info += '\r\n[{}] {}'.format(c.id, c.get_char_name())
-                if include_shownames and c.showname != '':
-                    info += ' ({})'.format(c.showname)
-                if not c.is_visible:
-                    info += ' (S)'
-                if self.is_mod:
-                    info += ' ({})'.format(c.ipid)
-            return info
+                info += ''.join([line for c, line in area.get_roster(self.is_mod, include_shownames)
+                                 if c == self or is_staff or c.is_visible or (mods and c.is_mod)])
+                return info
+
+            # The output only depends on what kind of viewer asks, so it is shared by everyone of
+            # the same kind. The exception is someone sneaking in the area, who also sees themselves.
+            if self.area == area and not is_staff and not self.is_visible:
+                return build()
+            return area.get_cached_roster(('info', is_staff, self.is_mod, mods, include_shownames), build)
 
         def send_area_info(self, current_area, area_id, mods, include_shownames=False):
             #If area_id is -1, then return all areas.
@@ -680,7 +891,7 @@ class ClientManager:
                     # Get area i details...
                     # If staff and there are clients in the area OR
                     # If not staff, there are visible clients in the area, and the area is reachable from the current one
-                    not_staff_check = len([c for c in self.server.area_manager.areas[i].clients if c.is_visible or c == self]) > 0 and \
+                    not_staff_check = (self.server.area_manager.areas[i].visible_count > 0 or self.area.id == i) and \
                                       (unrestricted_access_area or self.server.area_manager.areas[i].name in current_area.reachable_areas or self.is_transient)
 
                     if (self.is_staff() and len(self.server.area_manager.areas[i].clients) > 0) or \
@@ -721,25 +932,13 @@ class ClientManager:
             raise NotImplementedError
 
         def send_done(self):
-            avail_char_ids = set(range(len(self.server.char_list))) - self.area.get_chars_unusable(allow_restricted=self.is_staff())
-            # Readd sneaked players if needed so that they don't appear as taken
-            # Their characters will not be able to be reused, but at least that's one less clue about their presence.
-            if not self.is_staff():
-                avail_char_ids |= set([c.char_id for c in self.area.clients if not c.is_visible])
-
-            char_list = [-1] * len(self.server.char_list)
-            for x in avail_char_ids:
-                char_list[x] = 0
-            self.send_command('CharsCheck', *char_list)
-            self.send_command('HP', 1, self.area.hp_def)
-            self.send_command('HP', 2, self.area.hp_pro)
-            self.send_command('BN', self.area.background)
+            # Everything but the evidence list is shared with other clients joining the area
+            head, tail = self.area.get_join_bundle(self.is_staff())
+            self.send_frame(head)
             self.send_command('LE', *self.area.get_evidence_list(self))
-            self.send_command('MM', 1)
-            self.send_command('OPPASS', fantacrypt.fanta_encrypt(self.server.config['guardpass']))
             if self.char_id is None:
                 self.char_id = -1 # Set to a valid ID if still needed
-            self.send_command('DONE')
+            self.send_frame(tail)
 
         def char_select(self):
             self.char_id = -1
@@ -871,20 +1070,143 @@ class ClientManager:
                        'PLAY NORMIES PLS']
             return random.choice(message)
 
+    class ClientDirectory:
+        """
+        Indexes the connected clients by every key get_targets can look them up by.
+
+        IDs and IPIDs are plain dict lookups. IPs, OOC names and character names are matched
+        case-insensitively by prefix: a client is a target if the value starts with its key,
+        so that e.g. '/pm name message' finds 'name'. These keys are stored lowercased in a dict
+        along with how many distinct keys of each length there are, so a lookup costs one dict
+        access per distinct key length instead of a pass over every client.
+        """
+        PREFIX_TYPES = (TargetType.IP, TargetType.OOC_NAME, TargetType.CHAR_NAME)
+
+        def __init__(self):
+            self.by_id = dict()
+            self.by_ipid = dict()
+            self.prefix_indexes = {target_type: dict() for target_type in self.PREFIX_TYPES}
+            self.key_lengths = {target_type: Counter() for target_type in self.PREFIX_TYPES}
+            self.client_keys = dict() # Client -> {target type: key it is indexed under}
+
+        @staticmethod
+        def get_key(client, target_type):
+            if target_type == TargetType.IP:
+                return client.get_ipreal().lower()
+            if target_type == TargetType.OOC_NAME:
+                return client.name.lower() # Clients without an OOC name cannot be targeted by it
+            return client.get_char_name().lower()
+
+        def add(self, client):
+            self.by_id[client.id] = client
+            self.by_ipid.setdefault(client.ipid, set()).add(client)
+            self.client_keys[client] = dict()
+            for target_type in self.PREFIX_TYPES:
+                self.index(client, target_type)
+
+        def remove(self, client):
+            if self.by_id.get(client.id) is client:
+                del self.by_id[client.id]
+            clients = self.by_ipid[client.ipid]
+            clients.discard(client)
+            if not clients:
+                del self.by_ipid[client.ipid]
+            for target_type, key in self.client_keys.pop(client).items():
+                self.remove_key(target_type, key, client)
+
+        def index(self, client, target_type):
+            """
+            Updates the key a client is indexed under, after the client's IP, OOC name or
+            character name changed. Does nothing for clients that are not in the directory.
+            """
+            keys = self.client_keys.get(client)
+            if keys is None:
+                return
+            old_key = keys.pop(target_type, None)
+            if old_key is not None:
+                self.remove_key(target_type, old_key, client)
+            key = self.get_key(client, target_type)
+            if not key:
+                return
+            index = self.prefix_indexes[target_type]
+            clients = index.get(key)
+            if clients is None:
+                clients = index[key] = set()
+                self.key_lengths[target_type][len(key)] += 1
+            clients.add(client)
+            keys[target_type] = key
+
+        def remove_key(self, target_type, key, client):
+            index = self.prefix_indexes[target_type]
+            clients = index[key]
+            clients.discard(client)
+            if not clients:
+                del index[key]
+                key_lengths = self.key_lengths[target_type]
+                key_lengths[len(key)] -= 1
+                if key_lengths[len(key)] <= 0:
+                    del key_lengths[len(key)]
+
+        def find(self, target_type, value):
+            """ Returns the clients that match the value for the given target type, in no particular order. """
+            if target_type == TargetType.ID:
+                client = self.by_id.get(value)
+                return [client] if client is not None else []
+            if target_type == TargetType.IPID:
+                return list(self.by_ipid.get(value, ()))
+            if target_type not in self.PREFIX_TYPES or not isinstance(value, str):
+                return []
+            value = value.lower()
+            index = self.prefix_indexes[target_type]
+            targets = []
+            for length in self.key_lengths[target_type]:
+                if length <= len(value):
+                    clients = index.get(value[:length])
+                    if clients:
+                        targets.extend(clients)
+            return targets
+
     def __init__(self, server):
         self.clients = set()
         self.server = server
-        self.cur_id = [False] * self.server.config['playerlimit']
+        self.directory = self.ClientDirectory()
+        # Recipients of broadcasts that only reach some clients, see update_subscriptions
+        self.staff = set()
+        self.mods = set()
+        self.global_listeners = set()
+        self.advert_listeners = set()
+        # Min-heap of the client IDs below the player limit that are not in use,
+        # so that new clients always get the lowest one available
+        self.player_limit = self.server.config['playerlimit']
+        self.free_ids = list(range(self.player_limit))
+
+    def set_player_limit(self, player_limit):
+        """
+        Changes how many clients may be connected at once. Lowering the limit does not
+        disconnect anyone, but IDs past the new limit are not handed out again.
+        """
+        if player_limit > self.player_limit:
+            used_ids = set([c.id for c in self.clients])
+            for i in range(self.player_limit, player_limit):
+                if i not in used_ids:
+                    heapq.heappush(self.free_ids, i)
+        elif player_limit < self.player_limit:
+            self.free_ids = [i for i in self.free_ids if i < player_limit]
+            heapq.heapify(self.free_ids)
+        self.player_limit = player_limit
 
     def new_client(self, transport):
-        cur_id = 0
-        for i in range(self.server.config['playerlimit']):
-            if not self.cur_id[i]:
-                cur_id = i
-                break
-        c = self.Client(self.server, transport, cur_id, self.server.get_ipid(transport.get_extra_info('peername')[0]))
+        if not self.free_ids:
+            raise ServerError('Server is full.')
+        cur_id = heapq.heappop(self.free_ids)
+        try:
+            c = self.Client(self.server, transport, cur_id, self.server.get_ipid(transport.get_extra_info('peername')[0]))
+        except:
+            heapq.heappush(self.free_ids, cur_id)
+            raise
         self.clients.add(c)
-        self.cur_id[cur_id] = True
+        self.directory.add(c)
+        self.update_subscriptions(c)
         self.server.client_tasks[cur_id] = dict()
         return c
 
@@ -894,40 +1216,62 @@ class ClientManager:
             client.followedby.unfollow_user()
         except AttributeError:
             pass
-        self.cur_id[client.id] = False
+        if client.id < self.player_limit:
+            heapq.heappush(self.free_ids, client.id)
         for task_id in self.server.client_tasks[client.id].keys(): # Cancel client's pending tasks
             self.server.get_task(client, [task_id]).cancel()
+        if client.flush_handle is not None: # The connection is gone, nothing left to write to
+            client.flush_handle.cancel()
+        if client.stall_timer is not None:
+            client.stall_timer.cancel()
         self.clients.remove(client)
+        self.directory.remove(client)
+        for recipients in (self.staff, self.mods, self.global_listeners, self.advert_listeners):
+            recipients.discard(client)
+
+    def update_subscriptions(self, client):
+        """
+        Puts a connected client in the recipient sets that match its current staff roles and
+        global chat and advert mutes. Must be called whenever any of those change.
+        """
+        if client not in self.clients:
+            return
+        subscriptions = ((self.staff, client.is_staff()),
+                         (self.mods, client.is_mod),
+                         (self.global_listeners, not client.muted_global),
+                         (self.advert_listeners, not client.muted_adverts))
+        for recipients, subscribed in subscriptions:
+            if subscribed:
+                recipients.add(client)
+            else:
+                recipients.discard(client)
 
     def get_targets(self, client, key, value, local=False):
         #possible keys: ip, OOC, id, cname, ipid, hdid
-        areas = None
-        if local:
-            areas = [client.area]
-        else:
-            areas = client.server.area_manager.areas
-        targets = []
         if key == TargetType.ALL:
+            targets = []
+            # As before the client directory, plain ints match none of the target types, so
+            # ALL finds no one. No command relies on it.
             for nkey in range(6):
                 targets += self.get_targets(client, nkey, value, local)
-        for area in areas:
-            for c in area.clients:
-                if key == TargetType.IP:
-                    if value.lower().startswith(c.get_ipreal().lower()):
-                        targets.append(c)
-                elif key == TargetType.OOC_NAME:
-                    if value.lower().startswith(c.name.lower()) and c.name:
-                        targets.append(c)
-                elif key == TargetType.CHAR_NAME:
-                    if value.lower().startswith(c.get_char_name().lower()):
-                        targets.append(c)
-                elif key == TargetType.ID:
-                    if c.id == value:
-                        targets.append(c)
-                elif key == TargetType.IPID:
-                    if c.ipid == value:
-                        targets.append(c)
-        return targets
+            return targets
+        targets = self.directory.find(key, value)
+        if local:
+            targets = [c for c in targets if c.area == client.area]
+        # Same order as walking the areas by ID would give
+        return sorted(targets, key=lambda c: (c.area.id, c.id))
+
+    def reindex_char_names(self):
+        """
+        Updates the character names clients are indexed under, after the character list changed.
+        Clients whose character is past the end of the new list are sent back to character selection.
+        """
+        for c in self.clients:
+            if c.char_id is not None and c.char_id >= len(self.server.char_list):
+                c.send_host_message('Your character is no longer available, please pick another one.')
+                c.char_select() # Also reindexes the client
+            else:
+                self.directory.index(c, TargetType.CHAR_NAME)
 
     def get_muted_clients(self):
         clients = []
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #possible keys: ip, OOC, id, cname, ipid, hdid
+import functools
 import random
 import hashlib
 import string
@@ -22,6 +23,8 @@ import time
 from server.constants import TargetType
 
 from server import logger
+from server.aoprotocol import AOProtocol
+from server.chat_archive import format_event, parse_time
 from server.exceptions import ClientError, ServerError, ArgumentError, AreaError
 
 """ SUGGESTED IDEAS
@@ -662,9 +665,9 @@ def ooc_cmd_bloodtrail(client, arg):
     status = {False: 'no longer', True: 'now'}
     target = parse_id(client, arg)
 
-    num_bleeding_before = len([c for c in target.area.clients if c.is_bleeding])
+    num_bleeding_before = target.area.bleeding_count
     target.is_bleeding = not target.is_bleeding
-    num_bleeding_after = len([c for c in target.area.clients if c.is_bleeding])
+    num_bleeding_after = target.area.bleeding_count
 
     target.send_host_message('You are {} bleeding.'.format(status[target.is_bleeding]))
     target.send_host_others('{} is {} bleeding ({}).'.format(target.get_char_name(),
@@ -896,6 +899,7 @@ def ooc_cmd_char_restrict(client, arg):
                 c.send_host_message('Your character has been set to restricted in this area by a staff member. Switching you to {}.'.format(c.get_char_name()))
     else:
         client.area.restricted_chars.remove(arg)
+    client.area.invalidate_join_bundle()
 
 def ooc_cmd_chars_restricted(client, arg):
     """
@@ -1936,8 +1940,7 @@ def ooc_cmd_minimap(client, arg):
     info = '== Areas reachable from {} =='.format(client.area.name)
     try:
         # Get all reachable areas and sort them by area ID
-        sorted_areas = sorted(client.area.reachable_areas,
-                              key=lambda area_name: client.server.area_manager.get_area_by_name(area_name).id)
+        sorted_areas = client.area.get_sorted_reachable_areas()
 
         # No areas found or just the current area found means there are no reachable areas.
         if len(sorted_areas) == 0 or sorted_areas == [client.area.name]:
@@ -2111,6 +2114,60 @@ def ooc_cmd_mutepm(client, arg):
     status = {True: 'You stopped receiving PMs.', False: 'You are now receiving PMs.'}
     client.send_host_message(status[client.pm_mute])
 
+def ooc_cmd_netstats(client, arg):
+    """ (MOD ONLY)
+    Returns how many packets of each kind the server has rejected since it started because they
+    did not match the expected arguments or were sent too quickly, the clients that are not
+    keeping up with the data sent to them, and how many log records were dropped.
+
+    SYNTAX
+    /netstats
+
+    PARAMETERS
+    None
+
+    EXAMPLE
+    /netstats
+    """
+    if not client.is_mod:
+        raise ClientError('You must be authorized to do that.')
+    if len(arg) != 0:
+        raise ArgumentError('This command has no arguments.')
+
+    info = '== Rejected packets =='
+    schemas = [schema for schema in AOProtocol.net_cmd_schemas.values() if schema.rejected > 0]
+
+    if len(schemas) == 0:
+        info += '\r\n*No packets have been rejected.'
+    else:
+        for schema in schemas:
+            info += '\r\n*{}: {}'.format(schema.command, schema.rejected)
+
+    info += '\r\n== Flood-dropped packets =='
+    dropped = client.server.flood_guard.dropped
+
+    if len(dropped) == 0:
+        info += '\r\n*No packets have been dropped.'
+    else:
+        for command, count in dropped.most_common():
+            info += '\r\n*{}: {}'.format(command, count)
+
+    info += '\r\n== Slow clients =='
+    slow_clients = [c for c in client.server.client_manager.clients if c.write_paused or c.dropped_frames > 0]
+
+    if len(slow_clients) == 0:
+        info += '\r\n*No clients are falling behind.'
+    else:
+        for c in slow_clients:
+            info += ('\r\n*[{}] {}: {} bytes queued (peak {}), {} frames dropped{}'
+                     .format(c.id, c.get_char_name(), c.get_queue_depth(), c.peak_queue_depth,
+                             c.dropped_frames, ', paused' if c.write_paused else ''))
+
+    info += '\r\n== Logging =='
+    info += '\r\n*{} log records dropped.'.format(logger.get_dropped_count())
+
+    client.send_host_message(info)
+
 def ooc_cmd_online(client, arg):
     """
     Returns how many players are online.
@@ -2321,7 +2378,11 @@ def ooc_cmd_randomchar(client, arg):
 
 def ooc_cmd_refresh(client, arg):
     """ (MOD ONLY)
-    Reloads the following files for the server: characters, default music list, and background list.
+    Reloads the following files for the server: server configuration, characters, default music list, and background list.
+    A new player limit applies immediately, though lowering it does not disconnect anyone.
+    If the new server configuration is invalid, the old one is kept and nothing is reloaded.
+    New output_buffer limits only apply to clients who connect afterwards, and changes to
+    log_queue_size, log_rotation and chat_archive (as well as the port settings) need a server restart.
 
     SYNTAX
     /refresh
@@ -2602,10 +2663,10 @@ def ooc_cmd_scream(client, arg):
     if len(arg) == 0:
         raise ArgumentError("You cannot send an empty message.")
 
-    client.server.broadcast_global(client, arg, mtype="<dollar>SCREAM",
-                                   condition=lambda c: not c.muted_global and
-                                   (c.is_staff() or c.area == client.area or
-                                    c.area.name in client.area.scream_range))
+    recipients = set(client.server.client_manager.staff)
+    for area in [client.area] + client.area.get_scream_areas():
+        recipients |= area.clients
+    client.server.broadcast_global(client, arg, mtype="<dollar>SCREAM", recipients=recipients)
     logger.log_server('[{}][{}][SCREAM]{}.'.format(client.area.id, client.get_char_name(), arg), client)
 
 def ooc_cmd_scream_set_range(client, arg):
@@ -2682,7 +2743,7 @@ def ooc_cmd_scream_set(client, arg):
 
     # If intended area not in range, add it
     if intended_area.name not in client.area.scream_range:
-        client.area.scream_range.add(intended_area.name)
+        client.area.scream_range = client.area.scream_range | {intended_area.name}
         client.send_host_message('Added area {} to the scream range of area {}.'
                                  .format(intended_area.name, client.area.name))
         client.send_host_others('{} added area {} to the scream range of area {} ({}).'
@@ -2692,7 +2753,7 @@ def ooc_cmd_scream_set(client, arg):
                           .format(client.area.id, client.get_char_name(), intended_area.name,
                                   client.area.name), client)
     else: # Otherwise, add it
-        client.area.scream_range.remove(intended_area.name)
+        client.area.scream_range = client.area.scream_range - {intended_area.name}
         client.send_host_message('Removed area {} from the scream range of area {}.'
                                  .format(intended_area.name, client.area.name))
         client.send_host_others('{} removed area {} from the scream range of area {} ({}).'
@@ -2731,6 +2792,79 @@ def ooc_cmd_scream_range(client, arg):
 
     client.send_host_message(info)
 
+def ooc_cmd_searchlog(client, arg):
+    """ (MOD ONLY)
+    Searches the chat archive for IC, OOC, music and judge events, and returns the most recent
+    matches (at most 20 unless a limit is given), oldest first.
+    Filters are given as key=value pairs, and any remaining words must appear in the message as an exact phrase.
+    Times are either relative (30m, 12h, 7d) or UTC dates and times (2019-06-22, 2019-06-22T18:30).
+    The search runs in the background, so the results may arrive after other messages.
+    Returns an error if the archive is disabled in the server configuration.
+
+    SYNTAX
+    /searchlog {ipid=<ipid>} {area=<area_id>} {since=<time>} {until=<time>} {kind=<kind>} {limit=<limit>} {text}
+
+    PARAMETERS
+    <ipid>: IPID of the sender
+    <area_id>: ID of the area the event happened in
+    <time>: Start or end of the time range to search
+    <kind>: IC, OOC, music or judge
+    <limit>: Maximum number of results, up to 100
+    {text}: Exact phrase the message must contain
+
+    EXAMPLES
+    /searchlog ipid=1234567890              :: Returns the latest events of IPID 1234567890.
+    /searchlog area=0 since=2h kind=IC      :: Returns the latest IC messages in area 0 from the last two hours.
+    /searchlog since=2019-06-22 hello there :: Returns the latest messages containing "hello there" since June 22nd 2019.
+    """
+    if not client.is_mod:
+        raise ClientError('You must be authorized to do that.')
+    if client.server.chat_archive is None:
+        raise ClientError('The chat archive is disabled.')
+
+    filters = {'ipid': None, 'area': None, 'since': None, 'until': None, 'kind': None, 'limit': 20}
+    words = []
+    for word in arg.split():
+        key, _, value = word.partition('=')
+        if key not in filters or not value:
+            words.append(word)
+            continue
+        try:
+            if key in ('ipid', 'area', 'limit'):
+                filters[key] = int(value)
+            elif key in ('since', 'until'):
+                filters[key] = parse_time(value)
+            else:
+                filters[key] = {'ic': 'IC', 'ooc': 'OOC', 'music': 'music', 'judge': 'judge'}[value.lower()]
+        except (KeyError, ValueError):
+            raise ArgumentError('Invalid value for {}: {}.'.format(key, value))
+    if not 0 < filters['limit'] <= 100:
+        raise ArgumentError('The limit must be between 1 and 100.')
+
+    # Searching may open many days of archive, so keep it off the event loop
+    search = functools.partial(client.server.chat_archive.search, text=' '.join(words), **filters)
+    future = client.server.loop.run_in_executor(None, search)
+
+    def send_results(future):
+        if client not in client.server.client_manager.clients: # Left while searching
+            return
+        try:
+            events = future.result()
+        except Exception as exc:
+            logger.log_debug('Chat archive search failed: {}', client, exc)
+            client.send_host_message('The chat archive search failed.')
+            return
+
+        info = '== Chat archive search =='
+        if len(events) == 0:
+            info += '\r\n*No matching events.'
+        else:
+            for event in reversed(events):
+                info += '\r\n*{}'.format(format_event(event))
+        client.send_host_message(info)
+
+    future.add_done_callback(send_results)
+
 def ooc_cmd_showname(client, arg):
     """
     If given an argument, sets the client's showname to that.
@@ -2988,7 +3122,7 @@ def ooc_cmd_st(client, arg):
         raise ClientError('You must be authorized to do that.')
 
     pre = '{} [Staff] {}'.format(client.server.config['hostname'], client.name)
-    client.server.send_all_cmd_pred('CT', pre, arg, pred=lambda c: c.is_staff())
+    client.server.send_all_cmd_set(client.server.client_manager.staff, 'CT', pre, arg)
     logger.log_server('[{}][STAFFCHAT][{}][{}]{}.'.format(client.area.id, client.get_char_name(), client.name, arg), client)
 
 def ooc_cmd_switch(client, arg):
@@ -56,12 +56,12 @@ class DistrictClient:
                 glob_name = '{}[{}:{}][{}]'.format('<dollar>G', args[1], args[2], args[3])
                 if args[0] == '1':
                     glob_name += '[M]'
-                self.server.send_all_cmd_pred('CT', glob_name, args[4], pred=lambda x: not x.muted_global)
+                self.server.send_all_cmd_set(self.server.client_manager.global_listeners, 'CT', glob_name, args[4])
             elif cmd == 'NEED':
                 need_msg = '=== Cross Advert ===\r\n{} at {} in {} [{}] needs {}\r\n====================' \
                     .format(args[1], args[0], args[2], args[3], args[4])
-                self.server.send_all_cmd_pred('CT', '{}'.format(self.server.config['hostname']), need_msg,
-                                              pred=lambda x: not x.muted_adverts)
+                self.server.send_all_cmd_set(self.server.client_manager.advert_listeners, 'CT',
+                                             '{}'.format(self.server.config['hostname']), need_msg)
 
     async def write_queue(self):
         while self.message_queue:
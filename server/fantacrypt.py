@@ -17,29 +17,61 @@
 
 # fantacrypt was a mistake, just hardcoding some numbers is good enough
 
-import binascii
-
 CRYPT_CONST_1 = 53761
 CRYPT_CONST_2 = 32618
 CRYPT_KEY = 5
 
+# Only the low 16 bits of the key ever affect the output, so the key is truncated after
+# every step instead of being left to grow into an ever larger integer.
 
-def fanta_decrypt(data):
-    data_bytes = [int(data[x:x + 2], 16) for x in range(0, len(data), 2)]
+
+def fanta_decrypt_bytes(data):
+    """ Decrypts raw fantacrypt bytes.
+
+    :param data: bytes-like object
+    :return: decrypted bytes
+    """
     key = CRYPT_KEY
-    ret = ''
-    for byte in data_bytes:
-        val = byte ^ ((key & 0xffff) >> 8)
-        ret += chr(val)
-        key = ((byte + key) * CRYPT_CONST_1) + CRYPT_CONST_2
-    return ret
+    ret = bytearray(len(data))
+    for i, byte in enumerate(data):
+        ret[i] = byte ^ (key >> 8)
+        key = ((byte + key) * CRYPT_CONST_1 + CRYPT_CONST_2) & 0xffff
+    return bytes(ret)
 
 
-def fanta_encrypt(data):
+def fanta_encrypt_bytes(data):
+    """ Encrypts bytes with fantacrypt.
+
+    :param data: bytes-like object
+    :return: encrypted bytes
+    """
     key = CRYPT_KEY
-    ret = ''
-    for char in data:
-        val = ord(char) ^ ((key & 0xffff) >> 8)
-        ret += binascii.hexlify(val.to_bytes(1, byteorder='big')).decode().upper()
-        key = ((val + key) * CRYPT_CONST_1) + CRYPT_CONST_2
-    return ret
+    ret = bytearray(len(data))
+    for i, byte in enumerate(data):
+        val = byte ^ (key >> 8)
+        ret[i] = val
+        key = ((val + key) * CRYPT_CONST_1 + CRYPT_CONST_2) & 0xffff
+    return bytes(ret)
+
+
+def fanta_decrypt(data):
+    """ Decrypts a hex string as sent by old clients.
+
+    :param data: hex string
+    :return: decrypted string, one character per byte
+    """
+    if len(data) % 2:
+        # A trailing lone digit still counts as a byte
+        data_bytes = bytes.fromhex(data[:-1]) + bytes([int(data[-1], 16)])
+    else:
+        data_bytes = bytes.fromhex(data)
+    return fanta_decrypt_bytes(data_bytes).decode('latin-1')
+
+
+def fanta_encrypt(data):
+    """ Encrypts a string into the upper case hex form clients expect.
+
+    :param data: string of characters no greater than U+00FF
+    :return: hex string
+    """
+    return fanta_encrypt_bytes(data.encode('latin-1')).hex().upper()
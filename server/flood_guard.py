@@ -0,0 +1,138 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from collections import Counter
+
+from server import logger
+
+
+class FloodGuard:
+    """
+    Rate limits the packets each client sends with one token bucket per client and packet type.
+
+    A bucket holds up to `burst` tokens and refills at `rate` tokens per second; every packet
+    takes a token and is dropped if there is none. Each dropped packet is a strike against the
+    client and each accepted one removes a strike, so only sustained flooding adds up. Enough
+    strikes mute the client for a while (everything but keepalives is dropped), and clients who
+    keep flooding after several mutes are disconnected.
+    """
+    class Bucket:
+        __slots__ = ('tokens', 'updated')
+
+        def __init__(self, tokens, updated):
+            self.tokens = tokens
+            self.updated = updated
+
+    # Packets that are never limited: keepalives, so muted clients do not time out, and the
+    # evidence page requests of the AO1 handshake, which the server ignores anyway
+    EXEMPT_COMMANDS = ('CH', 'AE')
+    # Paged list requests an AO1 client sends back to back while joining, with the server
+    # attribute holding the pages it walks through
+    PAGED_COMMANDS = {'AN': 'char_pages_ao1', 'AM': 'music_pages_ao1'}
+    # Bucket shared by every packet type the server does not know, so junk names cannot add buckets
+    UNKNOWN_COMMAND = '?'
+
+    def __init__(self, server):
+        self.server = server
+        self.dropped = Counter()
+        self.default_limit = None
+        self.limits = dict()
+        self.strikes_to_mute = 0
+        self.mute_length = 0
+        self.mutes_to_disconnect = 0
+        self.load_config()
+
+    def load_config(self):
+        """ Reads the limits from the packet_floodguard section of the server configuration. """
+        config = self.server.config['packet_floodguard']
+        self.default_limit = (config['rate'], config['burst'])
+        self.limits = {command: (limit['rate'], limit['burst'])
+                       for command, limit in config.get('limits', dict()).items()}
+        self.strikes_to_mute = config['strikes_to_mute']
+        self.mute_length = config['mute_length']
+        self.mutes_to_disconnect = config['mutes_to_disconnect']
+
+    def get_limit(self, command):
+        """ Returns the (rate, burst) limit of a packet type. """
+        rate, burst = self.limits.get(command, self.default_limit)
+        pages = self.PAGED_COMMANDS.get(command)
+        if pages is not None:
+            # Allow one full walk through the list (plus the request past its end that ends
+            # it) on top of the configured burst, however long the list is
+            burst += len(getattr(self.server, pages) or ()) + 1
+        return rate, burst
+
+    def allow(self, client, command, known=True):
+        """
+        Takes a token from the client's bucket for the given packet type.
+
+        :param client: client that sent the packet
+        :param command: packet type (e.g. 'CT')
+        :param known: whether the server handles this packet type. Unknown ones all share
+        one bucket, so they cannot make the buckets and counters grow without bound.
+        :return: True if the packet may be handled, False if it must be dropped
+        """
+        if not known:
+            command = self.UNKNOWN_COMMAND
+        elif command in self.EXEMPT_COMMANDS:
+            return True
+        now = time.monotonic()
+        if client.flood_mute_end > now:
+            self.drop(client, command)
+            return False
+
+        rate, burst = self.get_limit(command)
+        bucket = client.flood_buckets.get(command)
+        if bucket is None:
+            bucket = client.flood_buckets[command] = self.Bucket(burst, now)
+        else:
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            if client.flood_strikes > 0:
+                client.flood_strikes -= 1
+            return True
+
+        self.drop(client, command)
+        client.flood_strikes += 1
+        if client.flood_strikes >= self.strikes_to_mute:
+            self.punish(client, now)
+        return False
+
+    def drop(self, client, command):
+        self.dropped[command] += 1
+        client.flood_dropped += 1
+
+    def punish(self, client, now):
+        """ Mutes a flooding client, or disconnects them if they were muted too many times already. """
+        client.flood_strikes = 0
+        client.flood_mutes += 1
+        if client.flood_mutes >= self.mutes_to_disconnect:
+            # Also drop whatever is left of the packets received along with this one
+            client.flood_mute_end = float('inf')
+            logger.log_server('Disconnected for flooding. {} packets dropped.'.format(client.flood_dropped), client)
+            client.disconnect()
+            return
+        client.flood_mute_end = now + self.mute_length
+        client.send_host_message('You are sending too many messages. You have been muted for {} seconds.'
+                                 .format(self.mute_length))
+        logger.log_server('Muted for flooding for {} seconds. {} packets dropped.'
+                          .format(self.mute_length, client.flood_dropped), client)
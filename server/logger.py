@@ -15,32 +15,146 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
 import logging
+import logging.handlers
+import queue
 import time
 
-def setup_logger(debug):
+debug_log = logging.getLogger('debug')
+server_log = logging.getLogger('server')
+archive_log = logging.getLogger('archive')
+
+# Set up by setup_logger
+log_queue_handler = None
+log_listener = None
+
+
+class LogMessage:
+    """
+    Log message whose str.format arguments are only applied when the record is written.
+
+    Records are written by the listener thread, so the arguments must not change afterwards;
+    the strings and numbers passed by the logging functions never do.
+    """
+    __slots__ = ('prefix', 'msg', 'args')
+
+    def __init__(self, prefix, msg, args):
+        self.prefix = prefix
+        self.msg = msg
+        self.args = args
+
+    def __str__(self):
+        if self.args:
+            return self.prefix + self.msg.format(*self.args)
+        return self.prefix + self.msg
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records over to the listener thread as they are, and drops them instead of blocking
+    when the queue is full, so a stalled disk never holds up the event loop.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class ArchiveHandler(logging.Handler):
+    """
+    Writes the events logged to the archive log into a ChatArchive.
+    """
+    def __init__(self, archive):
+        super().__init__()
+        self.archive = archive
+
+    def emit(self, record):
+        try:
+            self.archive.write(record.msg)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.archive.close()
+        super().close()
+
+
+def make_file_handler(filename, rotation):
+    """
+    Returns a handler writing to the given file, rotated by size if rotation['max_bytes'] is
+    positive, otherwise by time if rotation['when'] is set (e.g. 'midnight'), keeping
+    rotation['backup_count'] old files.
+    """
+    if rotation['max_bytes'] > 0:
+        return logging.handlers.RotatingFileHandler(filename, maxBytes=rotation['max_bytes'],
+                                                    backupCount=rotation['backup_count'], encoding='utf-8')
+    if rotation['when']:
+        return logging.handlers.TimedRotatingFileHandler(filename, when=rotation['when'], utc=True,
+                                                         backupCount=rotation['backup_count'], encoding='utf-8')
+    return logging.FileHandler(filename, encoding='utf-8')
+
+
+def setup_logger(debug, queue_size=10000, rotation=None, archive=None):
+    """
+    Sets up the debug and server logs, and the chat archive. Records are put on a bounded
+    queue and written to disk by a separate thread.
+
+    :param debug: whether to write the debug log
+    :param queue_size: number of records that may wait to be written before new ones are dropped
+    :param rotation: dict with max_bytes, when and backup_count, see make_file_handler
+    :param archive: ChatArchive events logged with log_archive are stored in, if any
+    """
+    global log_queue_handler, log_listener
+    if rotation is None:
+        rotation = {'max_bytes': 0, 'when': None, 'backup_count': 0}
+    stop_logger() # In case the logs were already set up
+
     logging.Formatter.converter = time.gmtime
     debug_formatter = logging.Formatter('[%(asctime)s UTC]%(message)s')
     srv_formatter = logging.Formatter('[%(asctime)s UTC]%(message)s')
 
-    debug_log = logging.getLogger('debug')
-    debug_log.setLevel(logging.DEBUG)
+    # Both logs share the queue, each file handler only writes the records of its own log
+    log_queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
 
-    debug_handler = logging.FileHandler('logs/debug.log', encoding='utf-8')
+    debug_log.setLevel(logging.DEBUG)
+    debug_log.addHandler(log_queue_handler)
+    debug_handler = make_file_handler('logs/debug.log', rotation)
     debug_handler.setLevel(logging.DEBUG)
     debug_handler.setFormatter(debug_formatter)
-    debug_log.addHandler(debug_handler)
+    debug_handler.addFilter(logging.Filter('debug'))
 
-    if not debug:
-        debug_log.disabled = True
+    debug_log.disabled = not debug
 
-    server_log = logging.getLogger('server')
     server_log.setLevel(logging.INFO)
-
-    server_handler = logging.FileHandler('logs/server.log', encoding='utf-8')
+    server_log.addHandler(log_queue_handler)
+    server_handler = make_file_handler('logs/server.log', rotation)
     server_handler.setLevel(logging.INFO)
     server_handler.setFormatter(srv_formatter)
-    server_log.addHandler(server_handler)
+    server_handler.addFilter(logging.Filter('server'))
+
+    handlers = [debug_handler, server_handler]
+    archive_log.setLevel(logging.INFO)
+    archive_log.propagate = False
+    archive_log.disabled = archive is None
+    if archive is not None:
+        archive_log.addHandler(log_queue_handler)
+        archive_handler = ArchiveHandler(archive)
+        archive_handler.addFilter(logging.Filter('archive'))
+        handlers.append(archive_handler)
+
+    log_listener = logging.handlers.QueueListener(log_queue_handler.queue, *handlers,
+                                                  respect_handler_level=True)
+    log_listener.start()
 
 #    rp_log = logging.getLogger('rp')
 #    rp_log.setLevel(logging.INFO)
@@ -50,13 +164,56 @@ def setup_logger(debug):
 #    rp_handler.setFormatter(rp_formatter)
 #    rp_log.addHandler(rp_handler)
 
-def log_debug(msg, client=None):
-    msg = parse_client_info(client) + msg
-    logging.getLogger('debug').debug(msg)
-
-def log_server(msg, client=None):
-    msg = parse_client_info(client) + msg
-    logging.getLogger('server').info(msg)
+@atexit.register
+def stop_logger():
+    """ Writes out every record still queued and stops the listener thread. """
+    global log_listener
+    if log_listener is None:
+        return
+    log_listener.stop()
+    for handler in log_listener.handlers:
+        handler.close()
+    debug_log.removeHandler(log_queue_handler)
+    server_log.removeHandler(log_queue_handler)
+    archive_log.removeHandler(log_queue_handler)
+    log_listener = None
+
+def get_dropped_count():
+    """ Returns how many records were dropped because the log queue was full. """
+    if log_queue_handler is None:
+        return 0
+    return log_queue_handler.dropped
+
+def log_debug(msg, client=None, *args):
+    """
+    Writes to the debug log, if enabled. Any args are applied to msg with str.format only
+    when the record is written.
+    """
+    if debug_log.disabled or not debug_log.isEnabledFor(logging.DEBUG):
+        return
+    debug_log.debug(LogMessage(parse_client_info(client), msg, args))
+
+def log_server(msg, client=None, *args):
+    """
+    Writes to the server log. Any args are applied to msg with str.format only when the
+    record is written.
+    """
+    if server_log.disabled or not server_log.isEnabledFor(logging.INFO):
+        return
+    server_log.info(LogMessage(parse_client_info(client), msg, args))
+
+def log_archive(kind, client, message):
+    """
+    Stores a chat event in the chat archive, if enabled.
+
+    :param kind: 'IC', 'OOC', 'music' or 'judge'
+    :param client: client the event comes from
+    :param message: message, song or judge action
+    """
+    if archive_log.disabled:
+        return
+    archive_log.info((time.time(), kind, client.area.id, client.id, client.ipid, client.get_char_name(),
+                      client.showname, message))
 
 def log_print(msg, client=None):
     msg = parse_client_info(client) + msg
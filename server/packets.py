@@ -0,0 +1,167 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Helpers that deal with the AO wire format itself, independent of any one client.
+
+from collections import namedtuple
+from enum import Enum
+
+# Frames a slow client can miss without its state going out of sync (OOC and server messages)
+NON_ESSENTIAL_FRAMES = (b'CT#',)
+
+
+def build_command(command, *args):
+    """ Serializes and encodes a command into a frame ready to be written to a transport.
+
+    The returned bytes object is immutable, so broadcasts can build it once and hand the
+    same frame to every recipient.
+
+    :param command: command name (e.g. 'CT')
+    :param args: command arguments, converted with str()
+    :return: the encoded frame, e.g. b'CT#name#message#%'
+    """
+    if args:
+        return '{}#{}#%'.format(command, '#'.join([str(x) for x in args])).encode('utf-8')
+    return '{}#%'.format(command).encode('utf-8')
+
+
+class PacketFramer:
+    """
+    Incremental splitter for the '#%'-terminated frames a client sends.
+
+    Incoming bytes are appended to a single bytearray and only the part that has not been
+    scanned yet is searched for a terminator, so a client pipelining many packets costs
+    linear time instead of re-copying the remaining buffer once per packet. Only complete
+    frames are decoded, which also keeps multi-byte characters split across two reads intact.
+    """
+    # exception because bad netcode
+    ASKCHAR2 = b'#615810BC07D12A5A#'
+
+    def __init__(self, limit=8192):
+        self.buffer = bytearray()
+        self.limit = limit
+        self.scan_offset = 0
+
+    def feed(self, data):
+        """ Appends received data to the buffer.
+
+        :param data: bytes received from the transport
+        :return: False if the unprocessed data now exceeds the size limit
+        """
+        self.buffer += data
+        return len(self.buffer) <= self.limit
+
+    def get_messages(self):
+        """ Extracts every complete frame currently in the buffer.
+
+        :return: list of decoded messages, without their '#%' terminators
+        """
+        buffer = self.buffer
+        messages = []
+        end = buffer.rfind(b'#%', self.scan_offset)
+        if end != -1:
+            # decode every complete frame in one go, '#%' cannot occur inside a utf-8 sequence
+            with memoryview(buffer) as view:
+                # try to decode as utf-8, ignore any erroneous characters
+                messages = str(view[:end], 'utf-8', 'ignore').split('#%')
+            del buffer[:end + 2]
+        if buffer == self.ASKCHAR2:
+            buffer.clear()
+            messages.append(self.ASKCHAR2.decode('utf-8'))
+        # a terminator may straddle two reads, so rescan the last byte next time
+        self.scan_offset = max(len(buffer) - 1, 0)
+        return messages
+
+
+class ArgType(Enum):
+    STR = 1,
+    STR_OR_EMPTY = 2,
+    INT = 3
+
+
+class AtLeast:
+    """
+    Allowed values for an INT argument with only a lower bound.
+    """
+    def __init__(self, minimum):
+        self.minimum = minimum
+
+    def __contains__(self, value):
+        return value >= self.minimum
+
+
+class NetCommandSchema:
+    """
+    Declares the arguments of a net command and validates incoming packets against them.
+
+    The declaration is turned into a validator once, when the schema is created, so checking
+    a packet is a length check plus one converter call per argument. Validated arguments are
+    returned as a namedtuple with the declared field names.
+    """
+    def __init__(self, command, *fields, extra_args=False):
+        """
+        :param command: command name (e.g. 'MS')
+        :param fields: (name, ArgType) or (name, ArgType, allowed values) tuples, in order
+        :param extra_args: whether trailing arguments past the declared ones are accepted
+        (and dropped) instead of rejecting the packet
+        """
+        self.command = command
+        self.fields = fields
+        self.extra_args = extra_args
+        self.args_type = namedtuple('{}Args'.format(command), [field[0] for field in fields])
+        self.rejected = 0
+        self.validate = self.compile()
+
+    @staticmethod
+    def make_converter(arg_type, allowed=None):
+        if arg_type == ArgType.INT:
+            convert = int # Also rejects empty arguments
+        elif arg_type == ArgType.STR:
+            def convert(arg):
+                if not arg:
+                    raise ValueError
+                return arg
+        else:
+            convert = str
+
+        if allowed is None:
+            return convert
+
+        def convert_allowed(arg):
+            value = convert(arg)
+            if value not in allowed:
+                raise ValueError
+            return value
+        return convert_allowed
+
+    def compile(self):
+        converters = tuple(self.make_converter(*field[1:]) for field in self.fields)
+        arg_count = len(converters)
+        extra_args = self.extra_args
+        make_args = self.args_type._make
+
+        def validate(args):
+            """ Returns the converted arguments, or None if the packet does not match the schema. """
+            if len(args) != arg_count and not (extra_args and len(args) > arg_count):
+                self.rejected += 1
+                return None
+            try:
+                return make_args([convert(arg) for convert, arg in zip(converters, args)])
+            except ValueError:
+                self.rejected += 1
+                return None
+        return validate
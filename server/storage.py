@@ -0,0 +1,134 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import os
+import sqlite3
+
+from server import logger
+
+
+class Database:
+    """
+    SQLite backed storage for IPIDs, HDIDs and bans.
+
+    Every lookup goes through an index (IP, IPID or HDID), so nothing has to be loaded or
+    rewritten as a whole. New IPIDs and HDIDs are committed some time after the first
+    uncommitted change, so a burst of connections costs a single commit; bans are committed
+    right away.
+    """
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path='storage/tsuserver.db', commit_delay=5):
+        self.path = path
+        self.commit_delay = commit_delay
+        self.commit_handle = None
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS ipids (ip TEXT PRIMARY KEY, ipid INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS ipids_by_ipid ON ipids (ipid);
+            CREATE TABLE IF NOT EXISTS hdids (hdid TEXT NOT NULL, ipid INTEGER NOT NULL,
+                                              PRIMARY KEY (hdid, ipid));
+            CREATE INDEX IF NOT EXISTS hdids_by_ipid ON hdids (ipid);
+            CREATE TABLE IF NOT EXISTS bans (ipid INTEGER PRIMARY KEY);
+            """)
+
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version < self.SCHEMA_VERSION:
+            self.migrate_json(os.path.dirname(path))
+            self.connection.execute('PRAGMA user_version={}'.format(self.SCHEMA_VERSION))
+            self.connection.commit()
+
+    def migrate_json(self, storage_dir):
+        """ Imports the JSON files older versions stored IPIDs, HDIDs and bans in.
+
+        Only runs once, when the database is created. The JSON files are left untouched.
+        """
+        def load(file_name, default):
+            file_path = os.path.join(storage_dir, file_name)
+            try:
+                with open(file_path, 'r', encoding='utf-8') as json_file:
+                    logger.log_print('Importing {} into {}.'.format(file_path, self.path))
+                    return json.load(json_file)
+            except FileNotFoundError:
+                return default
+            except ValueError:
+                logger.log_print('Failed to import {}, as it is not valid JSON.'.format(file_path))
+                return default
+
+        ipid_list = load('ip_ids.json', dict())
+        self.connection.executemany('INSERT OR IGNORE INTO ipids VALUES (?, ?)', ipid_list.items())
+
+        hdid_list = load('hd_ids.json', dict())
+        self.connection.executemany('INSERT OR IGNORE INTO hdids VALUES (?, ?)',
+                                    ((hdid, ipid) for hdid, ipids in hdid_list.items() for ipid in ipids))
+
+        bans = list()
+        for ipid in load('banlist.json', list()):
+            try:
+                bans.append((int(ipid),))
+            except ValueError:
+                logger.log_print('Skipping invalid banned IPID {}.'.format(ipid))
+        self.connection.executemany('INSERT OR IGNORE INTO bans VALUES (?)', bans)
+
+    def schedule_commit(self):
+        if self.commit_handle is None:
+            self.commit_handle = asyncio.get_event_loop().call_later(self.commit_delay, self.commit)
+
+    def commit(self):
+        if self.commit_handle is not None:
+            self.commit_handle.cancel()
+            self.commit_handle = None
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def get_ipid(self, ip):
+        row = self.connection.execute('SELECT ipid FROM ipids WHERE ip = ?', (ip,)).fetchone()
+        return row[0] if row else None
+
+    def ipid_exists(self, ipid):
+        return self.connection.execute('SELECT 1 FROM ipids WHERE ipid = ?', (ipid,)).fetchone() is not None
+
+    def add_ipid(self, ip, ipid):
+        self.connection.execute('INSERT INTO ipids VALUES (?, ?)', (ip, ipid))
+        self.schedule_commit()
+
+    def add_hdid(self, hdid, ipid):
+        cursor = self.connection.execute('INSERT OR IGNORE INTO hdids VALUES (?, ?)', (hdid, ipid))
+        if cursor.rowcount > 0:
+            self.schedule_commit()
+
+    def get_hdid_ipids(self, hdid):
+        return [row[0] for row in self.connection.execute('SELECT ipid FROM hdids WHERE hdid = ?', (hdid,))]
+
+    def get_bans(self):
+        return set(row[0] for row in self.connection.execute('SELECT ipid FROM bans'))
+
+    def add_ban(self, ipid):
+        self.connection.execute('INSERT OR IGNORE INTO bans VALUES (?)', (ipid,))
+        self.commit()
+
+    def remove_ban(self, ipid):
+        self.connection.execute('DELETE FROM bans WHERE ipid = ?', (ipid,))
+        self.commit()
@@ -0,0 +1,134 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import heapq
+import itertools
+import traceback
+
+
+class TimerManager:
+    """
+    Runs every delayed server action (AFK kicks, timers, handicaps, ping timeouts) off a
+    single heap and a single event loop callback armed for the earliest deadline.
+
+    Pushing a pending timer's deadline back only updates the timer; the heap entry is moved
+    lazily once its old deadline comes up. Resetting an AFK kick or a ping timeout is thus a
+    field update rather than a cancelled and recreated task.
+    """
+    class Timer:
+        PENDING = 0
+        EXPIRED = 1
+        CANCELLED = 2
+
+        def __init__(self, manager, deadline, callback, on_cancel):
+            self.manager = manager
+            self.deadline = deadline
+            self.callback = callback
+            self.on_cancel = on_cancel
+            self.state = self.PENDING
+            self.heap_token = None
+
+        def done(self):
+            return self.state != self.PENDING
+
+        def cancelled(self):
+            return self.state == self.CANCELLED
+
+        def cancel(self):
+            """ Stops the timer from expiring and runs its cancellation callback, if any. """
+            if self.state != self.PENDING:
+                return
+            self.state = self.CANCELLED
+            if self.on_cancel is not None:
+                self.manager.run_callback(self.on_cancel)
+
+        def reschedule(self, delay, callback=None):
+            """ Makes the timer expire `delay` seconds from now instead, even if it had expired.
+
+            :param delay: new delay in seconds
+            :param callback: new function to call on expiry, if it should change
+            """
+            if callback is not None:
+                self.callback = callback
+            deadline = self.manager.time() + delay
+            if self.state == self.PENDING and deadline >= self.deadline:
+                self.deadline = deadline
+                return
+            self.state = self.PENDING
+            self.deadline = deadline
+            self.manager.push(self)
+            self.manager.arm()
+
+    def __init__(self):
+        self.heap = list()
+        self.counter = itertools.count()
+        self.handle = None
+        self.handle_deadline = None
+
+    def time(self):
+        return asyncio.get_event_loop().time()
+
+    def schedule(self, delay, callback, on_cancel=None):
+        """ Calls `callback` after `delay` seconds, unless the returned timer is cancelled first.
+
+        :param delay: delay in seconds
+        :param callback: function taking no arguments
+        :param on_cancel: function taking no arguments, called if the timer is cancelled
+        :return: the timer
+        """
+        timer = self.Timer(self, self.time() + delay, callback, on_cancel)
+        self.push(timer)
+        self.arm()
+        return timer
+
+    def push(self, timer):
+        # Any heap entry of the timer with an older token is skipped once it comes up
+        timer.heap_token = next(self.counter)
+        heapq.heappush(self.heap, (timer.deadline, timer.heap_token, timer))
+
+    def arm(self):
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        if self.handle is not None:
+            if self.handle_deadline <= deadline:
+                return
+            self.handle.cancel()
+        self.handle_deadline = deadline
+        self.handle = asyncio.get_event_loop().call_at(deadline, self.expire)
+
+    def expire(self):
+        self.handle = None
+        now = self.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, token, timer = heapq.heappop(self.heap)
+            if token != timer.heap_token or timer.state != timer.PENDING:
+                continue
+            if timer.deadline > now:
+                # Deadline was pushed back since this entry was added
+                self.push(timer)
+                continue
+            timer.state = timer.EXPIRED
+            self.run_callback(timer.callback)
+        self.arm()
+
+    def run_callback(self, callback):
+        try:
+            callback()
+        except Exception:
+            traceback.print_exc()
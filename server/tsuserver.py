@@ -17,20 +17,26 @@
 
 import asyncio
 
-import json
+import os
 import random
 import time
 import importlib
 import yaml
 
+from server import fantacrypt
 from server import logger
+from server import packets
 from server.aoprotocol import AOProtocol
 from server.area_manager import AreaManager
 from server.ban_manager import BanManager
+from server.chat_archive import ChatArchive
 from server.client_manager import ClientManager
 from server.districtclient import DistrictClient
 from server.exceptions import ServerError
+from server.flood_guard import FloodGuard
 from server.masterserverclient import MasterServerClient
+from server.storage import Database
+from server.timer_manager import TimerManager
 
 class TsuServer3:
     def __init__(self):
@@ -50,33 +56,39 @@ class TsuServer3:
 
         self.allowed_iniswaps = None
         self.default_area = 0
+        self.music_list_frames = dict()
+        self.music_indexes = dict()
+        self.music_list_files = dict()
+        self.join_bundle_version = 0
+        self.player_count = 0 # Updated by the areas, see Area.count_client
         self.load_config()
+        self.flood_guard = FloodGuard(self)
         self.load_iniswaps()
         self.char_list = list()
         self.load_characters()
         self.client_manager = ClientManager(self)
         self.area_manager = AreaManager(self)
+        self.storage = Database(commit_delay=self.config['id_save_delay'])
         self.ban_manager = BanManager(self)
 
-        self.ipid_list = {}
-        self.hdid_list = {}
         self.char_pages_ao1 = None
         self.music_list = None
-        self.music_list_ao2 = None
         self.music_pages_ao1 = None
         self.backgrounds = None
         self.load_music()
         self.load_backgrounds()
-        self.load_ids()
         self.district_client = None
         self.ms_client = None
         self.rp_mode = False
         self.user_auth_req = False
         self.client_tasks = dict()
+        self.timer_manager = TimerManager()
         self.active_timers = dict()
         self.showname_freeze = False
         self.commands = importlib.import_module('server.commands')
-        logger.setup_logger(debug=self.config['debug'])
+        self.chat_archive = ChatArchive() if self.config['chat_archive'] else None
+        logger.setup_logger(debug=self.config['debug'], queue_size=self.config['log_queue_size'],
+                            rotation=self.config['log_rotation'], archive=self.chat_archive)
 
     def start(self):
         self.loop = asyncio.get_event_loop()
@@ -134,19 +146,24 @@ class TsuServer3:
                 client = next(iter(area.clients))
                 area.remove_client(client)
                 for task_id in self.client_tasks[client.id].keys():
-                    task = self.get_task(client, [task_id])
-                    self.loop.run_until_complete(self.await_cancellation(task))
+                    self.get_task(client, [task_id]).cancel()
+
+        # Save any IPIDs and HDIDs that are still waiting to be committed
+        self.storage.close()
 
     def get_version_string(self):
         return str(self.release) + '.' + str(self.major_version) + '.' + str(self.minor_version)
 
     def reload(self):
-        with open('config/characters.yaml', 'r') as chars:
-            self.char_list = yaml.safe_load(chars)
-        with open('config/music.yaml', 'r') as music:
-            self.music_list = yaml.safe_load(music)
-        self.build_music_pages_ao1()
-        self.build_music_list_ao2()
+        self.load_config()
+        # Apply the new configuration everywhere it was read at startup. Output buffer limits
+        # apply to new connections, and the logging and chat archive settings need a restart.
+        self.flood_guard.load_config()
+        self.storage.commit_delay = self.config['id_save_delay']
+        self.client_manager.set_player_limit(self.config['playerlimit'])
+        self.load_characters()
+        self.client_manager.reindex_char_names() # Also picks up a new spectator name
+        self.load_music()
         with open('config/backgrounds.yaml', 'r') as bgs:
             self.backgrounds = yaml.safe_load(bgs)
 
@@ -171,27 +188,46 @@ class TsuServer3:
 
     def get_player_count(self):
         # Ignore players in the server selection screen.
-        return len([client for client in self.client_manager.clients if client.char_id is not None])
+        return self.player_count
 
     def load_config(self):
+        """
+        Loads config/config.yaml. The whole file is read and checked before it replaces the
+        current configuration, so a bad file leaves the server running with the old one.
+        """
         with open('config/config.yaml', 'r', encoding='utf-8') as cfg:
-            self.config = yaml.safe_load(cfg)
-            self.config['motd'] = self.config['motd'].replace('\\n', ' \n')
-        if 'music_change_floodguard' not in self.config:
-            self.config['music_change_floodguard'] = {'times_per_interval': 1, 'interval_length': 0, 'mute_length': 0}
+            config = yaml.safe_load(cfg)
+            config['motd'] = config['motd'].replace('\\n', ' \n')
+        if 'music_change_floodguard' not in config:
+            config['music_change_floodguard'] = {'times_per_interval': 1, 'interval_length': 0, 'mute_length': 0}
         # Backwards compatibility checks
-        if 'spectator_name' not in self.config:
-            self.config['spectator_name'] = 'SPECTATOR'
-        if 'showname_max_length' not in self.config:
-            self.config['showname_max_length'] = 30
-        if 'sneak_handicap' not in self.config:
-            self.config['sneak_handicap'] = 5 # Seconds
-        if 'blackout_background' not in self.config:
-            self.config['blackout_background'] = 'Blackout_HD'
-        if 'discord_link' not in self.config:
-            self.config['discord_link'] = 'None'
-        if 'default_area_description' not in self.config:
-            self.config['default_area_description'] = 'No description.'
+        if 'spectator_name' not in config:
+            config['spectator_name'] = 'SPECTATOR'
+        if 'showname_max_length' not in config:
+            config['showname_max_length'] = 30
+        if 'sneak_handicap' not in config:
+            config['sneak_handicap'] = 5 # Seconds
+        if 'blackout_background' not in config:
+            config['blackout_background'] = 'Blackout_HD'
+        if 'discord_link' not in config:
+            config['discord_link'] = 'None'
+        if 'default_area_description' not in config:
+            config['default_area_description'] = 'No description.'
+        if 'id_save_delay' not in config:
+            config['id_save_delay'] = 5 # Seconds
+        # Sections given in part keep the defaults of the keys they leave out
+        config['output_buffer'] = {**{'high_watermark': 65536, 'low_watermark': 16384,
+                                      'max_queued': 262144, 'grace_period': 30},
+                                   **(config.get('output_buffer') or dict())}
+        if 'chat_archive' not in config:
+            config['chat_archive'] = True
+        if 'log_queue_size' not in config:
+            config['log_queue_size'] = 10000
+        config['log_rotation'] = {**{'max_bytes': 0, 'when': None, 'backup_count': 0},
+                                  **(config.get('log_rotation') or dict())}
+        config['packet_floodguard'] = {**{'rate': 10, 'burst': 20, 'strikes_to_mute': 20,
+                                          'mute_length': 30, 'mutes_to_disconnect': 3},
+                                       **(config.get('packet_floodguard') or dict())}
 
         # Check for uniqueness of all passwords
         passwords = ['guardpass',
@@ -208,64 +244,109 @@ class TsuServer3:
 
         for (i, password1) in enumerate(passwords):
             for (j, password2) in enumerate(passwords):
-                if i != j and self.config[password1] == self.config[password2]:
+                if i != j and config[password1] == config[password2]:
                     info = ('Passwords "{}" and "{}" in server/config.yaml match. '
                            'Please change them so they are different.'
                            .format(password1, password2))
                     raise ServerError(info)
 
+        self.config = config
+        # Every joining client is sent the guard password, so only encrypt it once per load
+        self.oppass_frame = packets.build_command('OPPASS', fantacrypt.fanta_encrypt(self.config['guardpass']))
+        self.motd_frame = packets.build_command('CT', self.config['hostname'], '=== MOTD ===\r\n{}\r\n============='
+                                                .format(self.config['motd']))
+        self.join_bundle_version += 1
+
     def load_characters(self):
         with open('config/characters.yaml', 'r', encoding='utf-8') as chars:
             self.char_list = yaml.safe_load(chars)
+        # Name lookups, keeping the first ID of a repeated name like list.index would
+        self.char_ids = dict()
+        self.char_ids_casefold = dict()
+        for char_id, char_name in enumerate(self.char_list):
+            self.char_ids.setdefault(char_name, char_id)
+            self.char_ids_casefold.setdefault(char_name.casefold(), char_id)
         self.build_char_pages_ao1()
+        self.join_bundle_version += 1
 
     def load_music(self, music_list_file='config/music.yaml', server_music_list=True):
-        try:
-            with open(music_list_file, 'r', encoding='utf-8') as music:
-                music_list = yaml.safe_load(music)
-        except FileNotFoundError:
-            raise ServerError('Could not find music list file {}'.format(music_list_file))
-
         if server_music_list:
+            music_list = self.read_music_list(music_list_file)
+            if self.music_list is not None:
+                self.music_indexes.pop(id(self.music_list), None)
             self.music_list = music_list
+            self.music_indexes[id(music_list)] = (music_list, self.build_music_index(music_list))
             self.build_music_pages_ao1()
-            self.build_music_list_ao2(music_list=music_list)
+            self.invalidate_music_list_frames()
+            return music_list
 
+        # Clients that load the same music list file share the parsed list and its song
+        # index, which are only read again if the file changed since it was last loaded.
+        try:
+            mtime = os.stat(music_list_file).st_mtime
+        except FileNotFoundError:
+            raise ServerError('Could not find music list file {}'.format(music_list_file))
+        try:
+            cached_mtime, music_list = self.music_list_files[music_list_file]
+            if cached_mtime == mtime:
+                return music_list
+            self.music_indexes.pop(id(music_list), None)
+        except KeyError:
+            pass
+
+        music_list = self.read_music_list(music_list_file)
+        self.music_list_files[music_list_file] = (mtime, music_list)
+        self.music_indexes[id(music_list)] = (music_list, self.build_music_index(music_list))
         return music_list
 
-    def load_ids(self):
-        self.ipid_list = {}
-        self.hdid_list = {}
-        #load ipids
+    def read_music_list(self, music_list_file):
         try:
-            with open('storage/ip_ids.json', 'r', encoding='utf-8') as whole_list:
-                self.ipid_list = json.loads(whole_list.read())
-        except:
-            logger.log_debug('Failed to load ip_ids.json from ./storage. If ip_ids.json exists, then remove it.')
-        #load hdids
-        try:
-            with open('storage/hd_ids.json', 'r', encoding='utf-8') as whole_list:
-                self.hdid_list = json.loads(whole_list.read())
-        except:
-            logger.log_debug('Failed to load hd_ids.json from ./storage. If hd_ids.json exists, then remove it.')
+            with open(music_list_file, 'r', encoding='utf-8') as music:
+                return yaml.safe_load(music)
+        except FileNotFoundError:
+            raise ServerError('Could not find music list file {}'.format(music_list_file))
 
-    def dump_ipids(self):
-        with open('storage/ip_ids.json', 'w') as whole_list:
-            json.dump(self.ipid_list, whole_list)
+    def build_music_index(self, music_list):
+        """ Maps every category and song name of a music list to its (name, length) pair.
 
-    def dump_hdids(self):
-        with open('storage/hd_ids.json', 'w') as whole_list:
-            json.dump(self.hdid_list, whole_list)
+        If a name appears more than once, the first occurrence wins, as with a linear search.
+        """
+        music_index = dict()
+        for item in music_list:
+            music_index.setdefault(item['category'], (item['category'], -1))
+            for song in item['songs']:
+                music_index.setdefault(song['name'], (song['name'], song.get('length', -1)))
+        return music_index
+
+    def get_music_index(self, music_list):
+        try:
+            return self.music_indexes[id(music_list)][1]
+        except KeyError:
+            pass
+        # List whose file was reloaded since a client loaded it. Index it once more and keep
+        # that until no client uses the list, clearing out other lists no one uses anymore.
+        self.evict_music_indexes()
+        music_index = self.build_music_index(music_list)
+        self.music_indexes[id(music_list)] = (music_list, music_index)
+        return music_index
+
+    def evict_music_indexes(self):
+        """ Drops the indexes of music lists that neither the server nor any client uses. """
+        in_use = set([id(self.music_list)])
+        in_use.update([id(music_list) for _, music_list in self.music_list_files.values()])
+        in_use.update([id(c.music_list) for c in self.client_manager.clients if c.music_list is not None])
+        for key in [key for key in self.music_indexes if key not in in_use]:
+            del self.music_indexes[key]
 
     def get_ipid(self, ip):
-        if not ip in self.ipid_list:
+        ipid = self.storage.get_ipid(ip)
+        if ipid is None:
             while True:
                 ipid = random.randint(0, 10**10-1)
-                if ipid not in self.ipid_list:
+                if not self.storage.ipid_exists(ipid):
                     break
-            self.ipid_list[ip] = ipid
-            self.dump_ipids()
-        return self.ipid_list[ip]
+            self.storage.add_ipid(ip, ipid)
+        return ipid
 
     def load_backgrounds(self):
         with open('config/backgrounds.yaml', 'r', encoding='utf-8') as bgs:
@@ -308,21 +389,69 @@ class TsuServer3:
             if c and c.music_list is not None:
                 music_list = c.music_list
 
-        self.music_list_ao2 = []
+        music_list_ao2 = []
         # Determine whether to filter the music list or not
         need_to_check = (from_area is None or '<ALL>' in from_area.reachable_areas
                          or (c is not None and (c.is_staff() or c.is_transient)))
 
         # add areas first
-        for area in self.area_manager.areas:
-            if need_to_check or area.name in from_area.reachable_areas:
-                self.music_list_ao2.append("{}-{}".format(area.id, area.name))
+        if need_to_check:
+            areas = self.area_manager.areas
+        else:
+            areas = [self.area_manager.get_area_by_name(area_name)
+                     for area_name in from_area.get_sorted_reachable_areas()]
+        for area in areas:
+            music_list_ao2.append("{}-{}".format(area.id, area.name))
 
         # then add music
         for item in music_list:
-            self.music_list_ao2.append(item['category'])
+            music_list_ao2.append(item['category'])
             for song in item['songs']:
-                self.music_list_ao2.append(song['name'])
+                music_list_ao2.append(song['name'])
+
+        return music_list_ao2
+
+    def get_music_list_frame(self, command, from_area=None, c=None):
+        """ Returns the encoded SM or FM frame carrying the AO2 music list.
+
+        Frames are cached by everything that can change the list's contents: the
+        reachable areas of from_area (unless the list is unfiltered), the music list
+        object and the command itself. The cache is emptied whenever areas or the
+        server music list are reloaded.
+
+        :param command: 'SM' or 'FM'
+        :param from_area: area whose reachable areas filter the list, if any
+        :param c: client the list is built for, if any
+        :return: the encoded frame
+        """
+        music_list = self.music_list
+        if c and c.music_list is not None:
+            music_list = c.music_list
+
+        if (from_area is None or '<ALL>' in from_area.reachable_areas
+            or (c is not None and (c.is_staff() or c.is_transient))):
+            reachable = None
+        else:
+            reachable = frozenset(from_area.reachable_areas)
+
+        key = (command, reachable, id(music_list))
+        try:
+            return self.music_list_frames[key][1]
+        except KeyError:
+            pass
+
+        # Every reachability edit can produce a new key, so keep the cache from
+        # growing without bound on long running servers.
+        if len(self.music_list_frames) >= 1024:
+            self.invalidate_music_list_frames()
+        frame = packets.build_command(command, *self.build_music_list_ao2(from_area=from_area, c=c,
+                                                                          music_list=music_list))
+        # Keep a reference to the music list so its id cannot be reused while cached
+        self.music_list_frames[key] = (music_list, frame)
+        return frame
+
+    def invalidate_music_list_frames(self):
+        self.music_list_frames.clear()
 
     def is_valid_char_id(self, char_id):
         return len(self.char_list) > char_id >= -1
@@ -330,42 +459,55 @@ class TsuServer3:
     def get_char_id_by_name(self, name):
         if name == self.config['spectator_name']:
             return -1
-        for i, ch in enumerate(self.char_list):
-            if ch.lower() == name.lower():
-                return i
-        raise ServerError('Character not found.')
+        try:
+            return self.char_ids_casefold[name.casefold()]
+        except KeyError:
+            raise ServerError('Character not found.')
 
     def get_song_data(self, music, c=None):
+        try:
+            return self.get_music_index(self.music_list)[music]
+        except KeyError:
+            pass
         # The client's personal music list should also be a valid place to search
         # so search in there too if possible
         if c and c.music_list:
-            valid_music = self.music_list + c.music_list
-        else:
-            valid_music = self.music_list
-
-        for item in valid_music:
-            if item['category'] == music:
-                return item['category'], -1
-            for song in item['songs']:
-                if song['name'] == music:
-                    try:
-                        return song['name'], song['length']
-                    except KeyError:
-                        return song['name'], -1
+            try:
+                return self.get_music_index(c.music_list)[music]
+            except KeyError:
+                pass
         raise ServerError('Music not found.')
 
     def send_all_cmd_pred(self, cmd, *args, pred=lambda x: True):
-        for client in self.client_manager.clients:
-            if pred(client):
-                client.send_command(cmd, *args)
-
-    def broadcast_global(self, client, msg, as_mod=False,
-                         mtype="<dollar>G", condition=lambda x: not x.muted_global):
+        self.send_all_cmd_set(self.client_manager.clients, cmd, *args, pred=pred)
+
+    def send_all_cmd_set(self, recipients, cmd, *args, pred=None):
+        """
+        Sends a command to a set of clients kept up to date elsewhere, such as
+        client_manager.mods or an area's clients, so that a broadcast meant for a few clients
+        does not visit everyone connected.
+
+        :param recipients: set of clients
+        :param pred: optional condition recipients must also satisfy
+        """
+        frame = packets.build_command(cmd, *args)
+        for client in recipients:
+            if pred is None or pred(client):
+                client.send_frame(frame)
+
+    def broadcast_global(self, client, msg, as_mod=False, mtype="<dollar>G", recipients=None):
+        """
+        Sends a message to everyone with global chat on, or only to those of the given
+        recipients who have it on.
+        """
         username = client.name
         ooc_name = '{}[{}][{}]'.format(mtype, client.area.id, username)
         if as_mod:
             ooc_name += '[M]'
-        self.send_all_cmd_pred('CT', ooc_name, msg, pred=condition)
+        listeners = self.client_manager.global_listeners
+        if recipients is not None:
+            listeners = listeners & recipients
+        self.send_all_cmd_set(listeners, 'CT', ooc_name, msg)
         if self.config['use_district']:
             self.district_client.send_raw_message(
                 'GLOBAL#{}#{}#{}#{}'.format(int(as_mod), client.area.id, username, msg))
@@ -374,29 +516,33 @@ class TsuServer3:
         char_name = client.get_char_name()
         area_name = client.area.name
         area_id = client.area.id
-        self.send_all_cmd_pred('CT', '{}'.format(self.config['hostname']),
-                               '=== Advert ===\r\n{} in {} [{}] needs {}\r\n==============='
-                               .format(char_name, area_name, area_id, msg), pred=lambda x: not x.muted_adverts)
+        self.send_all_cmd_set(self.client_manager.advert_listeners, 'CT', '{}'.format(self.config['hostname']),
+                              '=== Advert ===\r\n{} in {} [{}] needs {}\r\n==============='
+                              .format(char_name, area_name, area_id, msg))
         if self.config['use_district']:
             self.district_client.send_raw_message('NEED#{}#{}#{}#{}'.format(char_name, area_name, area_id, msg))
 
     def create_task(self, client, args):
-        # Abort old task if it exists
+        """ Starts the timer-driven task args[0] for a client, replacing any previous one.
+
+        Each task method receives the client, the remaining arguments and the previous
+        timer of that task (or None), and returns the new timer, or None if there is nothing
+        to schedule.
+        """
         try:
             old_task = self.get_task(client, args)
-            if not old_task.done() and not old_task.cancelled():
-                self.cancel_task(old_task)
         except KeyError:
-            pass
+            old_task = None
 
-        # Start new task
-        self.client_tasks[client.id][args[0]] = (asyncio.ensure_future(getattr(self, args[0])(client, args[1:]), loop=self.loop),
-                                                 args[1:])
+        task = getattr(self, args[0])(client, args[1:], old_task)
+        if task is None:
+            self.client_tasks[client.id].pop(args[0], None)
+        else:
+            self.client_tasks[client.id][args[0]] = (task, args[1:])
 
     def cancel_task(self, task):
-        """ Cancels current task and sends order to await cancellation """
+        """ Cancels current task """
         task.cancel()
-        asyncio.ensure_future(self.await_cancellation(task))
 
     def remove_task(self, client, args):
         """ Given client and task name, removes task from server.client_tasks, and cancels it """
@@ -418,79 +564,89 @@ class TsuServer3:
         except asyncio.CancelledError:
             pass
 
-    async def as_afk_kick(self, client, args):
+    def as_afk_kick(self, client, args, old_task):
         afk_delay, afk_sendto = args
         try:
             delay = int(afk_delay)*60 # afk_delay is in minutes, so convert to seconds
         except (TypeError, ValueError):
-            raise ServerError('The area file contains an invalid AFK kick delay for area {}: {}'.format(client.area.id, afk_delay))
+            logger.log_print('The area file contains an invalid AFK kick delay for area {}: {}'.format(client.area.id, afk_delay))
+            delay = 0
 
         if delay <= 0: # Assumes 0-minute delay means that AFK kicking is disabled
+            if old_task is not None:
+                old_task.cancel()
+            return None
+
+        callback = lambda: self.afk_kick(client, afk_delay, afk_sendto)
+        # Nothing happens when an AFK kick is cancelled, so just push back the pending one
+        if old_task is not None and not old_task.done():
+            old_task.reschedule(delay, callback=callback)
+            return old_task
+        return self.timer_manager.schedule(delay, callback)
+
+    def afk_kick(self, client, afk_delay, afk_sendto):
+        try:
+            area = client.server.area_manager.get_area_by_id(int(afk_sendto))
+        except:
+            raise ServerError('The area file contains an invalid AFK kick destination area for area {}: {}'.format(client.area.id, afk_sendto))
+
+        if client.area.id == afk_sendto: # Don't try and kick back to same area
+            return
+        if client.char_id < 0: # Assumes spectators are exempted from AFK kicks
+            return
+        if client.is_staff(): # Assumes staff are exempted from AFK kicks
             return
 
         try:
-            await asyncio.sleep(delay)
-        except asyncio.CancelledError:
-            raise
+            original_area = client.area
+            client.change_area(area, override_passages=True, override_effects=True, ignore_bleeding=True)
+        except:
+            pass # Server raised an error trying to perform the AFK kick, ignore AFK kick
         else:
-            try:
-                area = client.server.area_manager.get_area_by_id(int(afk_sendto))
-            except:
-                raise ServerError('The area file contains an invalid AFK kick destination area for area {}: {}'.format(client.area.id, afk_sendto))
+            client.send_host_message("You were kicked from area {} to area {} for being inactive for {} minutes.".format(original_area.id, afk_sendto, afk_delay))
 
-            if client.area.id == afk_sendto: # Don't try and kick back to same area
-                return
-            if client.char_id < 0: # Assumes spectators are exempted from AFK kicks
-                return
-            if client.is_staff(): # Assumes staff are exempted from AFK kicks
-                return
+            if client.area.is_locked or client.area.is_modlocked:
+                client.area.invite_list.pop(client.ipid)
 
-            try:
-                original_area = client.area
-                client.change_area(area, override_passages=True, override_effects=True, ignore_bleeding=True)
-            except:
-                pass # Server raised an error trying to perform the AFK kick, ignore AFK kick
-            else:
-                client.send_host_message("You were kicked from area {} to area {} for being inactive for {} minutes.".format(original_area.id, afk_sendto, afk_delay))
-
-                if client.area.is_locked or client.area.is_modlocked:
-                    client.area.invite_list.pop(client.ipid)
-
-    async def as_timer(self, client, args):
+    def as_timer(self, client, args, old_task):
         _, length, name, is_public = args # Length in seconds, already converted
         client_name = client.name # Failsafe in case client disconnects before task is cancelled/expires
 
-        try:
-            await asyncio.sleep(length)
-        except asyncio.CancelledError:
-            self.send_all_cmd_pred('CT', '{}'.format(self.config['hostname']),
-                                   'Timer "{}" initiated by {} has been canceled.'
-                                   .format(name, client_name),
-                                   pred=lambda c: (c == client or c.is_staff() or
-                                                   (is_public and c.area == client.area)))
-        else:
-            self.send_all_cmd_pred('CT', '{}'.format(self.config['hostname']),
-                                   'Timer "{}" initiated by {} has expired.'
-                                   .format(name, client_name),
-                                   pred=lambda c: (c == client or c.is_staff() or
-                                                   (is_public and c.area == client.area)))
-        finally:
+        if old_task is not None:
+            old_task.cancel()
+
+        def end_timer(outcome):
+            recipients = set(self.client_manager.staff)
+            if is_public:
+                recipients |= client.area.clients
+            if client in self.client_manager.clients:
+                recipients.add(client)
+            self.send_all_cmd_set(recipients, 'CT', '{}'.format(self.config['hostname']),
+                                  'Timer "{}" initiated by {} has {}.'
+                                  .format(name, client_name, outcome))
             del self.active_timers[name]
 
-    async def as_handicap(self, client, args):
+        return self.timer_manager.schedule(length, lambda: end_timer('expired'),
+                                           on_cancel=lambda: end_timer('been canceled'))
+
+    def as_handicap(self, client, args, old_task):
         _, length, _, announce_if_over = args
+
+        if old_task is not None:
+            old_task.cancel()
         client.is_movement_handicapped = True
 
-        try:
-            await asyncio.sleep(length)
-        except asyncio.CancelledError:
-            pass # Cancellation messages via send_host_messages must be sent manually
-        else:
+        def expire():
+            client.is_movement_handicapped = False
             if announce_if_over and not client.is_staff():
                 client.send_host_message('Your movement handicap has expired. You may now move to a new area.')
-        finally:
+
+        def cancel():
+            # Cancellation messages via send_host_messages must be sent manually
             client.is_movement_handicapped = False
 
+        return self.timer_manager.schedule(length, expire, on_cancel=cancel)
+
     def timer_remaining(self, start, length):
         current = time.time()
         remaining = start+length-current